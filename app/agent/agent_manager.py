@@ -1,92 +1,223 @@
 """
 Agent manager for handling different types of agents
 """
-from typing import Dict, Any, Optional, List, TypedDict
+import asyncio
+import re
+import sys
+from typing import Dict, Any, Optional, List, TypedDict, Callable, Awaitable
 from typing_extensions import NotRequired
 from loguru import logger
 from app.agent.employee_agent import create_employee_info_agent
-from app.agent.doc2bot_agent import create_doc2bot_agent
+from app.agent.doc2bot_agent import create_doc2bot_agent, is_shared_mcp, refresh_shared_mcp
 from openai import AsyncOpenAI
 from app.drag.drag_service import *
 from app.service.message_context import AgentRunningContext
 from app.core.stream_card import StreamCard
 from openai.types.responses import ResponseTextDeltaEvent
 from app.core.agent import HandleResult
+from app.utils.loop_local import LoopLocal
 
 from agents import (
     
-    Runner,set_default_openai_client, set_default_openai_api, set_tracing_disabled
+    Agent, Runner,set_default_openai_client, set_default_openai_api, set_tracing_disabled
     
 )
 
 from app.config.settings import settings
 from app.service.message_context import MessageContext
 
+# 输入匹配时直接预取的工具：(输入格式, 工具名, 参数名)
+# traceId 为 30 位、agentCode 为 32 位的十六进制字符串；只有 Agent 的 MCP 服务器提供该工具时才预取
+_PREFETCH_RULES = (
+    (re.compile(r"[0-9a-fA-F]{30}"), "query_qa_detail_info", "trace_id"),
+    (re.compile(r"[0-9a-fA-F]{32}"), "call_agent_code", "agent_code"),
+)
+
+
+def _enable_eager_task_factory():
+    """
+    为当前事件循环启用 eager task factory（Python 3.12+）
+    流式事件消费、卡片更新、MCP 工具调度中大量协程在第一次 await 前就能完成，
+    eager 模式下这些任务同步执行到真正挂起为止，省去一次调度往返
+    """
+    if sys.version_info < (3, 12):
+        return
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return
+    if loop.get_task_factory() is None:
+        loop.set_task_factory(asyncio.eager_task_factory)
+
+
+def _create_llm_client() -> AsyncOpenAI:
+    """创建 LLM 客户端并设置为 agents SDK 的全局默认客户端"""
+    base_url = settings.LLM_API_BASE_URL
+    api_key = settings.LLM_API_KEY
+
+    if not base_url or not api_key:
+        raise ValueError("Please set LLM_API_BASE_URL and LLM_API_KEY")
+
+    client = AsyncOpenAI(
+        base_url=base_url,
+        api_key=api_key
+    )
+    set_default_openai_client(client=client, use_for_tracing=False)
+    set_default_openai_api("chat_completions")
+    set_tracing_disabled(disabled=True)
+    logger.info(" LLM Client 设置成功")
+    return client
+
+
+# 同一事件循环内的 AgentManager 共用一个客户端，保留到 LLM 服务的 keep-alive 连接，
+# 全局默认客户端也只在创建时设置一次
+_llm_client = LoopLocal(_create_llm_client)
+
+
 class AgentManager:
-    def __init__(self, current_user_info: Optional[Dict[str, Any]] = None):
+    def __init__(
+        self,
+        current_user_info: Optional[Dict[str, Any]] = None,
+        agent_factory: Callable[[], Awaitable[Agent]] = create_doc2bot_agent,
+    ):
         self.current_user_info = current_user_info or {}
-        self.agent = None
+        # 创建 Agent 的工厂函数，默认为 doc2bot，也可以传入 create_employee_info_agent 等
+        self.agent_factory = agent_factory
+        self._agent = None
+        self._agent_lock = asyncio.Lock()
         self.client = None
-        self._setup_llm_client()
+        # 正在使用本实例处理的消息数，由调用方维护；不为 0 时不能清理
+        self.active_runs = 0
+        _enable_eager_task_factory()
         logger.info(f"初始化 AgentManager，用户信息: {self.current_user_info}")
 
+    def update_context(self, current_user_info: Optional[Dict[str, Any]] = None):
+        """复用实例处理新消息时更新用户信息，Agent 和 MCP 连接保持不变"""
+        self.current_user_info = current_user_info or {}
+
     def _setup_llm_client(self):
-        """设置 LLM 客户端和全局配置"""
+        """获取当前事件循环共享的 LLM 客户端"""
         try:
-            base_url = settings.LLM_API_BASE_URL
-            api_key = settings.LLM_API_KEY
-            
-            if not base_url or not api_key:
-                raise ValueError("Please set LLM_API_BASE_URL and LLM_API_KEY")
-            
-            self.client = AsyncOpenAI(
-                base_url=base_url,
-                api_key=api_key
-            )
-            set_default_openai_client(client=self.client, use_for_tracing=False)
-            set_default_openai_api("chat_completions")
-            set_tracing_disabled(disabled=True)
-            logger.info(" LLM Client 设置成功")
+            self.client = _llm_client.get()
         except Exception as e:
-            logger.error(f"LLM Client 设置失败: {str(e)}", exc_info=True)
+            logger.opt(exception=True).error(f"LLM Client 设置失败: {str(e)}")
             raise
 
 
+    async def _get_agent(self):
+        """获取 Agent，首次调用时创建，之后在 AgentManager 生命周期内复用（含 MCP 服务器连接）"""
+        async with self._agent_lock:
+            if self.client is None:
+                self._setup_llm_client()
+            if self._agent is None:
+                self._agent = await self.agent_factory()
+            else:
+                # 复用的 Agent 上的共享 MCP 子进程可能已经退出，换成可用的实例
+                await refresh_shared_mcp(self._agent)
+            return self._agent
+
+    async def _prefetch_tool_result(self, agent, content: str) -> Optional[str]:
+        """
+        用户输入只有一个 traceId 或 agentCode 时，直接调用 MCP 工具查询，
+        把结果随输入一起交给模型，省去一轮"由模型决定调用工具"的 LLM 往返
+        """
+        text = content.strip()
+        for pattern, tool_name, arg_name in _PREFETCH_RULES:
+            if pattern.fullmatch(text):
+                break
+        else:
+            return None
+        server = await self._find_tool_server(agent, tool_name)
+        if server is None:
+            return None
+        try:
+            result = await server.call_tool(tool_name, {arg_name: text})
+        except Exception as e:
+            logger.warning(f"预取工具结果失败，交由模型调用工具: {str(e)}")
+            return None
+        if result.isError:
+            return None
+        output = "\n".join(item.text for item in result.content if hasattr(item, "text"))
+        return f"{text}\n\n已通过工具 {tool_name} 查询到以下结果，无需再次调用该工具：\n{output}"
+
+    @staticmethod
+    async def _find_tool_server(agent, tool_name: str):
+        """返回提供该工具的 MCP 服务器，没有则返回 None；工具列表由服务器缓存，不会每次都请求"""
+        for server in agent.mcp_servers:
+            try:
+                tools = await server.list_tools()
+            except Exception as e:
+                logger.warning(f"获取 MCP 服务器 {server.name} 的工具列表失败: {str(e)}")
+                continue
+            if any(tool.name == tool_name for tool in tools):
+                return server
+        return None
+
     async def cleanup(self):
         """清理资源"""
         try:
-            # 停止所有 MCP 服务器
-            for server in self.agent.mcp_servers:
-                try:
-                    await server.cleanup()
-                    logger.info(f"MCP 服务器 {server.name} 已清理")
-                except Exception as e:
-                    logger.error(f"清理 MCP 服务器 {server.name} 失败: {str(e)}")
-            self.agent.mcp_servers = []
-            self.agent = None
+            if self._agent is not None:
+                # 并发停止本实例独占的 MCP 服务器，共享的服务器由进程统一持有
+                servers = [server for server in self._agent.mcp_servers if not is_shared_mcp(server)]
+                results = await asyncio.gather(*(server.cleanup() for server in servers), return_exceptions=True)
+                for server, result in zip(servers, results):
+                    if isinstance(result, BaseException):
+                        logger.error(f"清理 MCP 服务器 {server.name} 失败: {str(result)}")
+                    else:
+                        logger.info(f"MCP 服务器 {server.name} 已清理")
+                self._agent.mcp_servers = []
+                self._agent = None
             self.client = None
             logger.info("所有资源已清理")
         except Exception as e:
-            logger.error(f"清理资源失败: {str(e)}", exc_info=True)
+            logger.opt(exception=True).error(f"清理资源失败: {str(e)}")
             raise
 
 
+    async def _stream_to_card(self, result, stream_card: StreamCard):
+        """
+        读取模型流式输出并增量更新卡片
+        update_delta 只在本地累积内容并提交给 reply_service，由它按卡片合并发送，不会阻塞读取
+        """
+        async for event in result.stream_events():
+            if event.type == "raw_response_event" and isinstance(event.data, ResponseTextDeltaEvent):
+                # 空增量没有内容可展示，直接跳过
+                if not event.data.delta:
+                    continue
+                logger.opt(lazy=True).debug("event delta: {}", lambda: event.data.delta)
+                try:
+                    await stream_card.update_delta(event.data.delta)
+                except Exception as e:
+                    logger.warning(f"更新卡片内容失败: {str(e)}")
+
     async def process_message(self, context: MessageContext) -> HandleResult:
         """处理消息"""
         try:
             logger.info(f"收到消息: {context.content}")
-            # agent 执行逻辑
-            self.agent = await create_doc2bot_agent()
-            # 1. 新建流式卡片，卡片会显示在AI助理的聊天窗口中
-            stream_card = await StreamCard.create(context.conversation_token)
+
+            async def prepare_input():
+                # agent 执行逻辑
+                agent = await self._get_agent()
+                prefetched = await self._prefetch_tool_result(agent, context.content)
+                return agent, prefetched or context.content
+
+            # 1. 新建流式卡片，卡片会显示在AI助理的聊天窗口中；
+            # 卡片请求不依赖 Agent，与 Agent 创建、工具预取并发进行，不再串行等待一次网络往返
+            card_task = asyncio.create_task(StreamCard.create(context.conversation_token))
+            input_task = asyncio.create_task(prepare_input())
+            try:
+                stream_card, (agent, agent_input) = await asyncio.gather(card_task, input_task)
+            except BaseException:
+                # 任一失败时取消另一个，原始异常直接抛出
+                card_task.cancel()
+                input_task.cancel()
+                raise
 
             agent_running_context = AgentRunningContext(context=context, stream_card=stream_card)
-            result = Runner.run_streamed(self.agent, context=agent_running_context, input=context.content)
-            async for event in result.stream_events():
-                if event.type == "raw_response_event" and isinstance(event.data, ResponseTextDeltaEvent):
-                    logger.info("event delta: {}".format(event.data.delta))
-                    # 增量更新卡片内容
-                    await stream_card.update_delta(event.data.delta)
+            result = Runner.run_streamed(agent, context=agent_running_context, input=agent_input)
+            # 增量更新卡片内容
+            await self._stream_to_card(result, stream_card)
+            logger.info(f"回复完成: {result.final_output}")
 
             # 结束卡片更新，停止等待动画
             await stream_card.finish()
@@ -94,5 +225,5 @@ class AgentManager:
             # 返回成功，AI助理平台根据直通模式的配置，会忽略这个返回值
             return HandleResult(200, "OK", "OK")
         except Exception as e:
-            logger.error(f"处理消息失败: {str(e)}", exc_info=True)
+            logger.opt(exception=True).error(f"处理消息失败: {str(e)}")
             return HandleResult(500, "Internal Server Error", str(e))
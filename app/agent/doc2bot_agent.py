@@ -1,31 +1,20 @@
-import os.path
+import asyncio
+import weakref
 
-from agents import Agent
+from agents import Agent, ModelSettings
+from loguru import logger
 from app.config.settings import settings
 from agents.mcp import MCPServerStdio
 from agents.run_context import RunContextWrapper
-from datetime import datetime
 from app.service.message_context import MessageContext
-async def dynamic_instructions(context: RunContextWrapper[MessageContext], agent: Agent[MessageContext]) -> str:
-    # 递归解包context，直到找到MessageContext
-    ctx = context
-    while hasattr(ctx, "context") and not isinstance(ctx, MessageContext):
-        ctx = ctx.context
-
-    # 直接使用当前时间
-    dt = datetime.now()
-    formatted_time = dt.strftime("%Y-%m-%d %H:%M:%S")
-
-    # 构建基础用户信息部分
-    user_info = (
-        f"## 用户信息\n"
-        f"- 当前用户名: {ctx.user_name or '未知'}\n"
-        f"- 当前用户工号: {ctx.user_id or '未知'}\n"
-        f"- 当前时间: {formatted_time}\n"
-    )
+from app.utils.loop_local import LoopLocal
 
-    # 基础信息查询助理的核心指令
-    core_instruction = """
+_MODEL = settings.LLM_API_MODEL
+# 允许模型在一轮中发出多个工具调用，SDK 会并发执行它们，总耗时取最慢的一个而不是逐个相加
+_MODEL_SETTINGS = ModelSettings(parallel_tool_calls=True)
+
+# 基础信息查询助理的核心指令
+_CORE = """
 ## 角色
 你是一个问答系统的排查助理，可以通过traceId查询（traceId是30位长的字符串，如：0b51258d17479908039123525e1507）一次问答请求的明细。
 也可以通过agentCode查询(agentCode是32位长的字符串，如：b8a1c28240be40c88e5b45706960a45e）助理学习知识的详情
@@ -41,8 +30,8 @@ async def dynamic_instructions(context: RunContextWrapper[MessageContext], agent
 3. 整合查询结果，以结构化格式输出
 """
 
-    # 工作流程示例部分
-    workflow_examples = """
+# 工作流程示例部分
+_EXAMPLES = """
 ### 工作流程示例
 **回答效果排查流程**:
 1. 解析用户输入，提取出traceId
@@ -59,31 +48,116 @@ async def dynamic_instructions(context: RunContextWrapper[MessageContext], agent
 如果是查询学习详情请用表格输出
 """
 
-    # 组合完整的动态指令
-    final_instruction = f"{core_instruction}\n{workflow_examples}\n\n如果用户不知道如何获取traceId可以告诉用户去问答的卡片上点击任意一篇引用来源在浏览器打开，url上面有traceId参数，复制出来即可。agentCode去助理编辑页的集成开发tab下复制Assistant ID即可"
-    return final_instruction
+_TAIL = "如果用户不知道如何获取traceId可以告诉用户去问答的卡片上点击任意一篇引用来源在浏览器打开，url上面有traceId参数，复制出来即可。agentCode去助理编辑页的集成开发tab下复制Assistant ID即可"
+
+# 指令不依赖用户信息和时间，导入时拼接一次即可
+_INSTRUCTIONS = f"{_CORE}\n{_EXAMPLES}\n\n{_TAIL}"
+
+
+async def dynamic_instructions(context: RunContextWrapper[MessageContext], agent: Agent[MessageContext]) -> str:
+    return _INSTRUCTIONS
 
 # MCP服务器创建函数
 async def create_doc2bot_info_mcp():
-    script_path = os.path.dirname(os.path.abspath(__file__)) + "/server/doc2bot_mcp_server.py"
     mcp_server = MCPServerStdio(
         name="qa_debug_mcp",
         params={
             "command": "python",
-            "args": [script_path]
+            "args": [settings.DOC2BOT_MCP_PATH]
         },
-        client_session_timeout_seconds = 600.0
+        client_session_timeout_seconds = 600.0,
+        cache_tools_list=True
     )
-    await mcp_server.connect()
+    try:
+        await mcp_server.connect()
+    except BaseException:
+        # 连接失败时回收已经拉起的子进程，下次调用重新创建
+        await _discard_mcp(mcp_server)
+        raise
     return mcp_server
 
+
+# 检查共享 MCP 子进程是否仍可用的超时时间（秒）
+_PING_TIMEOUT = 5
+
+
+async def _is_mcp_alive(server) -> bool:
+    """通过 MCP ping 检查会话和子进程是否仍然可用"""
+    session = getattr(server, "session", None)
+    if session is None:
+        return False
+    try:
+        await asyncio.wait_for(session.send_ping(), timeout=_PING_TIMEOUT)
+        return True
+    except Exception:
+        return False
+
+
+async def _discard_mcp(server) -> None:
+    """关闭 MCP 服务器，忽略关闭过程中的错误"""
+    try:
+        await server.cleanup()
+    except Exception as e:
+        logger.warning(f"关闭 MCP 服务器 {server.name} 失败: {str(e)}")
+
+
+class _SharedMcpState:
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.server = None
+
+
+# 同一事件循环内所有 AgentManager 共用一个 MCP 子进程，stdio 会话按请求 id 复用，支持并发调用
+_shared_mcp = LoopLocal(_SharedMcpState)
+_shared_servers = weakref.WeakSet()
+
+
+async def get_shared_doc2bot_mcp():
+    """
+    获取共享的 MCP 服务器，首次调用时创建并连接
+    返回前先 ping 一次，子进程退出或会话断开时关闭旧实例并重新创建
+    """
+    state = _shared_mcp.get()
+    async with state.lock:
+        if state.server is not None and not await _is_mcp_alive(state.server):
+            logger.warning("共享的 MCP 服务器已不可用，重新创建")
+            await _discard_mcp(state.server)
+            state.server = None
+        if state.server is None:
+            state.server = await create_doc2bot_info_mcp()
+            _shared_servers.add(state.server)
+        return state.server
+
+
+async def close_shared_doc2bot_mcp() -> None:
+    """关闭当前事件循环上的共享 MCP 服务器，事件循环结束前调用"""
+    state = _shared_mcp.get()
+    async with state.lock:
+        if state.server is not None:
+            await _discard_mcp(state.server)
+            state.server = None
+
+
+def is_shared_mcp(server) -> bool:
+    """共享的 MCP 服务器由进程统一持有，AgentManager 清理时不应关闭"""
+    return server in _shared_servers
+
+
+async def refresh_shared_mcp(agent: Agent) -> None:
+    """把复用的 Agent 上的共享 MCP 服务器换成当前可用的实例（必要时会重新创建）"""
+    if not any(is_shared_mcp(server) for server in agent.mcp_servers):
+        return
+    current = await get_shared_doc2bot_mcp()
+    agent.mcp_servers = [current if is_shared_mcp(server) else server for server in agent.mcp_servers]
+
 # Agent工厂函数
 async def create_doc2bot_agent():
-    mcp_server = await create_doc2bot_info_mcp()
+    mcp_server = await get_shared_doc2bot_mcp()
     agent = Agent[MessageContext](
         name="问答问题排查助手",
         instructions=dynamic_instructions,
-        model=settings.LLM_API_MODEL,
+        model=_MODEL,
+        model_settings=_MODEL_SETTINGS,
         mcp_servers=[mcp_server]
     )
     return agent
@@ -1,29 +1,16 @@
-from agents import Agent
+from agents import Agent, ModelSettings
 from app.config.settings import settings
 from agents.mcp import MCPServerStdio
 from agents.run_context import RunContextWrapper
-from datetime import datetime
+import time
 from app.service.message_context import MessageContext
-async def dynamic_instructions(context: RunContextWrapper[MessageContext], agent: Agent[MessageContext]) -> str:
-    # 递归解包context，直到找到MessageContext
-    ctx = context
-    while hasattr(ctx, "context") and not isinstance(ctx, MessageContext):
-        ctx = ctx.context
-
-    # 直接使用当前时间
-    dt = datetime.now()
-    formatted_time = dt.strftime("%Y-%m-%d %H:%M:%S")
 
-    # 构建基础用户信息部分
-    user_info = (
-        f"## 用户信息\n"
-        f"- 当前用户名: {ctx.user_name or '未知'}\n"
-        f"- 当前用户工号: {ctx.user_id or '未知'}\n"
-        f"- 当前时间: {formatted_time}\n"
-    )
+_MODEL = settings.LLM_API_MODEL
+# 允许模型在一轮中发出多个工具调用，SDK 会并发执行它们，总耗时取最慢的一个而不是逐个相加
+_MODEL_SETTINGS = ModelSettings(parallel_tool_calls=True)
 
-    # 基础信息查询助理的核心指令
-    core_instruction = """
+# 基础信息查询助理的核心指令
+_CORE = """
 ## 角色
 你是一个专业的基础信息查询助手，主要负责解析用户请求并提取所需的用户信息和团队数据，为后续的分析处理提供基础支持。
 
@@ -39,8 +26,8 @@ async def dynamic_instructions(context: RunContextWrapper[MessageContext], agent
 3. 整合查询结果，以结构化格式输出
 """
 
-    # 工作流程示例部分
-    workflow_examples = """
+# 工作流程示例部分
+_EXAMPLES = """
 ### 工作流程示例
 **基础用户信息查询流程**:
 1. 解析用户输入，识别涉及的用户名或昵称
@@ -65,9 +52,43 @@ async def dynamic_instructions(context: RunContextWrapper[MessageContext], agent
 - uid: 用户ID
 """
 
-    # 组合完整的动态指令
-    final_instruction = f"{user_info}\n{core_instruction}\n{workflow_examples}\n\n请根据用户输入，提取所需的用户信息和团队数据，为后续处理提供基础支持。输出必须是一个包含用户信息的列表。"
-    return final_instruction
+_TAIL = "请根据用户输入，提取所需的用户信息和团队数据，为后续处理提供基础支持。输出必须是一个包含用户信息的列表。"
+
+
+# (秒级时间戳, 格式化后的时间)，提示词只需要秒级精度，同一秒内复用格式化结果
+_fmt_cache = (0, "")
+
+
+def _formatted_now() -> str:
+    global _fmt_cache
+    now = int(time.time())
+    if now != _fmt_cache[0]:
+        _fmt_cache = (now, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(now)))
+    return _fmt_cache[1]
+
+
+def _unwrap_ctx(ctx, max_depth: int = 4) -> MessageContext:
+    """解包 RunContextWrapper 等包装层，直到找到 MessageContext"""
+    for _ in range(max_depth):
+        if isinstance(ctx, MessageContext):
+            return ctx
+        inner = getattr(ctx, "context", None)
+        if inner is None:
+            break
+        ctx = inner
+    return ctx
+
+
+async def dynamic_instructions(context: RunContextWrapper[MessageContext], agent: Agent[MessageContext]) -> str:
+    ctx = _unwrap_ctx(context)
+    # 只有用户信息和时间是动态的，其余部分在导入时已经构建好
+    return (
+        f"## 用户信息\n"
+        f"- 当前用户名: {ctx.user_name or '未知'}\n"
+        f"- 当前用户工号: {ctx.user_id or '未知'}\n"
+        f"- 当前时间: {_formatted_now()}\n"
+        f"\n{_CORE}\n{_EXAMPLES}\n\n{_TAIL}"
+    )
 
 # MCP服务器创建函数
 async def create_employee_info_mcp():
@@ -81,7 +102,8 @@ async def create_employee_info_mcp():
                 "DINGTALK_APP_SECRET": settings.DINGTALK_CLIENT_SECRET
             }
         },
-        client_session_timeout_seconds=600.0
+        client_session_timeout_seconds=600.0,
+        cache_tools_list=True
     )
     await mcp_server.connect()
     return mcp_server
@@ -92,7 +114,8 @@ async def create_employee_info_agent():
     agent = Agent[MessageContext](
         name="Employee info query agent",
         instructions=dynamic_instructions,
-        model=settings.LLM_API_MODEL,
+        model=_MODEL,
+        model_settings=_MODEL_SETTINGS,
         mcp_servers=[mcp_server]
     )
     return agent
@@ -1,14 +1,109 @@
+import asyncio
+import random
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 from mcp.server.fastmcp import FastMCP
-from typing import Dict, Any
+from typing import Dict, Any, AsyncIterator
 from loguru import logger
 
 import httpx
-
-# 创建 MCP 服务器实例
-mcp = FastMCP("QADetailInfoServer")
+import orjson
 
 # 可提取为配置文件或环境变量
 QA_TRACE_URL = "https://pre-lippi-doc2bot.dingtalk.com/qa/trace"
+QA_STUDY_URL = "https://pre-lippi-doc2bot.dingtalk.com/qa/studyDetail"
+
+# 所有工具调用共用一个连接池，避免每次调用都重新做 DNS、TCP 和 TLS 握手
+_client = httpx.AsyncClient(
+    timeout=5.0,
+    http2=True,
+    limits=httpx.Limits(max_keepalive_connections=16, keepalive_expiry=60)
+)
+
+# trace_id -> (处理后明细的 JSON, 过期时间)，按 LRU 淘汰；同一个 trace 的明细不会变化，
+# 预取和模型再次调用同一个 traceId 时不必重复请求
+_TRACE_CACHE_MAX_SIZE = 2048
+_TRACE_CACHE_TTL = 300
+_trace_cache: "OrderedDict[str, tuple]" = OrderedDict()
+
+# 问答明细请求遇到超时、连接断开和 5xx 时按指数退避（带抖动）重试
+_RETRY_ATTEMPTS = 3
+_RETRY_INITIAL_DELAY = 0.1
+_RETRY_MAX_DELAY = 1.5
+
+
+class QATraceUnavailableError(Exception):
+    """问答明细服务熔断中，调用被直接拒绝"""
+
+
+class _CircuitBreaker:
+    """
+    简单熔断器：连续失败 fail_max 次后打开，reset_timeout 秒内的调用直接拒绝；
+    之后每个 reset_timeout 周期只放行一次试探，成功则关闭
+    """
+
+    def __init__(self, fail_max: int, reset_timeout: float):
+        self.fail_max = fail_max
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+
+    def allow(self) -> bool:
+        if self._opened_at is None:
+            return True
+        now = time.monotonic()
+        if now - self._opened_at >= self.reset_timeout:
+            self._opened_at = now
+            return True
+        return False
+
+    def record_success(self) -> None:
+        self._failures = 0
+        self._opened_at = None
+
+    def record_failure(self) -> None:
+        self._failures += 1
+        if self._failures >= self.fail_max:
+            self._opened_at = time.monotonic()
+
+
+_trace_breaker = _CircuitBreaker(fail_max=5, reset_timeout=30)
+
+
+async def _post_trace(trace_id: str) -> httpx.Response:
+    """
+    发送问答明细请求，失败时退避重试，重试用尽后抛出最后一次的异常；
+    每次调用（含重试）只向熔断器记录一次成功或失败，4xx 不算作服务故障
+    """
+    if not _trace_breaker.allow():
+        raise QATraceUnavailableError("QA trace service is unavailable, circuit open")
+    for attempt in range(_RETRY_ATTEMPTS):
+        try:
+            response = await _client.post(QA_TRACE_URL, json={"traceId": trace_id})
+            if response.status_code < 500:
+                _trace_breaker.record_success()
+                return response
+            response.raise_for_status()
+        except (httpx.TransportError, httpx.HTTPStatusError) as e:
+            if attempt == _RETRY_ATTEMPTS - 1:
+                _trace_breaker.record_failure()
+                raise
+            delay = random.uniform(0, min(_RETRY_MAX_DELAY, _RETRY_INITIAL_DELAY * 2 ** attempt))
+            logger.warning(f"问答明细请求失败，{delay:.2f}s 后重试: {str(e)}")
+            await asyncio.sleep(delay)
+
+
+@asynccontextmanager
+async def _lifespan(server: FastMCP) -> AsyncIterator[None]:
+    try:
+        yield
+    finally:
+        await _client.aclose()
+
+
+# 创建 MCP 服务器实例
+mcp = FastMCP("QADetailInfoServer", lifespan=_lifespan)
 
 @mcp.tool()
 async def query_qa_detail_info(trace_id: str) -> Dict[str, Any]:
@@ -19,22 +114,35 @@ async def query_qa_detail_info(trace_id: str) -> Dict[str, Any]:
     返回:
         问答明细的对象
     """
-    async with httpx.AsyncClient(timeout=5.0) as client:
-        try:
-            response = await client.post(
-                QA_TRACE_URL,
-                json={"traceId": trace_id}
-            )
-            response.raise_for_status()
-            result = response.json()
-            if 'retrievalList' in result['result']:
-                result['result']['retrievalList'] = [{'content': f"标题:{item.get('name', '')} 答案:{item.get('content', '')}", 'score': item.get('score', 0)} for item in result['result']['retrievalList']]
-            # 可以添加日志记录用于调试
-            logger.info(f"处理后的问答明细: {result}")
-            return result
-        except httpx.RequestError as e:
-            # 可记录日志并抛出自定义异常或返回默认结构
-            raise RuntimeError(f"Network error occurred: {e}")
+    # 缓存的是编码后的 JSON，每次命中都解码出新的对象，调用方修改结果不会污染缓存
+    cached = _trace_cache.get(trace_id)
+    if cached is not None:
+        data, expires_at = cached
+        if time.monotonic() < expires_at:
+            _trace_cache.move_to_end(trace_id)
+            return orjson.loads(data)
+        del _trace_cache[trace_id]
+
+    try:
+        response = await _post_trace(trace_id)
+        response.raise_for_status()
+        result = orjson.loads(response.content)
+        detail = result.get('result') or {}
+        retrieval_list = detail.get('retrievalList')
+        if retrieval_list is not None:
+            detail['retrievalList'] = [
+                {'content': f"标题:{item.get('name', '')} 答案:{item.get('content', '')}", 'score': item.get('score', 0)}
+                for item in retrieval_list
+            ]
+        # 明细可能很大，只在 DEBUG 级别下才格式化
+        logger.opt(lazy=True).debug("处理后的问答明细: {}", lambda: result)
+        _trace_cache[trace_id] = (orjson.dumps(result), time.monotonic() + _TRACE_CACHE_TTL)
+        if len(_trace_cache) > _TRACE_CACHE_MAX_SIZE:
+            _trace_cache.popitem(last=False)
+        return result
+    except httpx.RequestError as e:
+        # 可记录日志并抛出自定义异常或返回默认结构
+        raise RuntimeError(f"Network error occurred: {e}")
 
 
 @mcp.tool()
@@ -46,19 +154,19 @@ async def call_agent_code(agent_code: str) -> Dict[str, Any]:
     返回:
         学习详情信息
     """
-    async with httpx.AsyncClient(timeout=5.0) as client:
-        try:
-            response = await client.post(
-                "https://pre-lippi-doc2bot.dingtalk.com/qa/studyDetail",
-                json={"agentCode": agent_code}
-            )
-            response.raise_for_status()
-            result = response.json()
-            logger.info(f"处理后的智能助手返回结果: {result}")
-            return result
-        except httpx.RequestError as e:
-            # 可记录日志并抛出自定义异常或返回默认结构
-            raise RuntimeError(f"Network error occurred: {e}")
+    try:
+        response = await _client.post(
+            QA_STUDY_URL,
+            json={"agentCode": agent_code}
+        )
+        response.raise_for_status()
+        result = orjson.loads(response.content)
+        # 返回结果可能很大，只在 DEBUG 级别下才格式化
+        logger.opt(lazy=True).debug("处理后的智能助手返回结果: {}", lambda: result)
+        return result
+    except httpx.RequestError as e:
+        # 可记录日志并抛出自定义异常或返回默认结构
+        raise RuntimeError(f"Network error occurred: {e}")
 
 
 @mcp.resource("employee://{id}")
@@ -1,24 +1,51 @@
 import os
+from dataclasses import dataclass
+from pathlib import Path
 
 from dotenv import load_dotenv
 
 load_dotenv()
 
+@dataclass(frozen=True, slots=True)
 class Settings:
     """Application settings"""
 
     # DingTalk API configuration
     # For Stream API (WebSocket)
-    DINGTALK_CLIENT_ID = os.getenv("DINGTALK_CLIENT_ID", "")
-    DINGTALK_CLIENT_SECRET = os.getenv("DINGTALK_CLIENT_SECRET", "")
-    DINGTALK_STREAM_TOPIC = os.getenv("DINGTALK_STREAM_TOPIC", "/v1.0/graph/api/invoke")
+    DINGTALK_CLIENT_ID: str
+    DINGTALK_CLIENT_SECRET: str
+    DINGTALK_STREAM_TOPIC: str
 
     # CARD TEMPLATE ID
-    DINGTALK_CARD_TEMPLATE_ID = os.getenv("DINGTALK_CARD_TEMPLATE_ID", "9c178dc6-57e9-4952-afbf-77bc4efbf21c.schema")
+    DINGTALK_CARD_TEMPLATE_ID: str
 
     # LLM API configuration
-    LLM_API_KEY = os.getenv("LLM_API_KEY", "")
-    LLM_API_BASE_URL = os.getenv("LLM_API_BASE_URL", "https://dashscope.aliyuncs.com/compatible-mode/v1")
-    LLM_API_MODEL = os.getenv("LLM_API_MODEL", "qwen-plus")
+    LLM_API_KEY: str
+    LLM_API_BASE_URL: str
+    LLM_API_MODEL: str
 
-settings = Settings()
\ No newline at end of file
+    # MCP server configuration
+    DOC2BOT_MCP_PATH: str
+
+    # 同时处理的消息数上限
+    MAX_CONCURRENT_MESSAGES: int
+
+    @classmethod
+    def from_env(cls) -> "Settings":
+        """从环境变量读取配置，只在导入时执行一次"""
+        return cls(
+            DINGTALK_CLIENT_ID=os.getenv("DINGTALK_CLIENT_ID", ""),
+            DINGTALK_CLIENT_SECRET=os.getenv("DINGTALK_CLIENT_SECRET", ""),
+            DINGTALK_STREAM_TOPIC=os.getenv("DINGTALK_STREAM_TOPIC", "/v1.0/graph/api/invoke"),
+            DINGTALK_CARD_TEMPLATE_ID=os.getenv("DINGTALK_CARD_TEMPLATE_ID", "9c178dc6-57e9-4952-afbf-77bc4efbf21c.schema"),
+            LLM_API_KEY=os.getenv("LLM_API_KEY", ""),
+            LLM_API_BASE_URL=os.getenv("LLM_API_BASE_URL", "https://dashscope.aliyuncs.com/compatible-mode/v1"),
+            LLM_API_MODEL=os.getenv("LLM_API_MODEL", "qwen-plus"),
+            DOC2BOT_MCP_PATH=os.getenv(
+                "DOC2BOT_MCP_PATH",
+                str(Path(__file__).resolve().parent.parent / "agent" / "server" / "doc2bot_mcp_server.py")
+            ),
+            MAX_CONCURRENT_MESSAGES=int(os.getenv("MAX_CONCURRENT_MESSAGES", "32")),
+        )
+
+settings = Settings.from_env()
@@ -1,8 +1,7 @@
+import asyncio
 from loguru import logger
 from dataclasses import dataclass
-import json
 from enum import IntEnum
-from threading import Lock
 
 from app.service.reply_service import reply_service, ContentType, CardData
 
@@ -30,7 +29,25 @@ class StepStatus(IntEnum):
     """
 
 
-@dataclass
+# 卡片更新的 options 是固定的，只读共享，不必每次更新都重新构建
+_STREAMING_OPTIONS = {"componentTag": "streamingComponent"}
+_STATIC_OPTIONS = {"componentTag": "staticComponent"}
+
+_TEMPLATE_ID = "4b6e421f-5300-4ba4-bb0b-0fcea69051f0.schema"
+
+# 占位的空流式内容对所有卡片都相同，共享一个 CardData，编码结果也只需计算一次
+_EMPTY_STREAM_CARD = CardData(
+    card_data={
+        "key": "result",  # 流式更新，只更新result字段
+        "value": "~",
+        "isFinalize": False,  # 流式输出中，不能设置为True
+    },
+    options=_STREAMING_OPTIONS,
+    template_id=_TEMPLATE_ID,
+)
+
+
+@dataclass(slots=True)
 class _PlanStep:
     taskId: str
     status: int
@@ -38,6 +55,15 @@ class _PlanStep:
     output: str
     expand: bool
 
+    def to_dict(self) -> dict:
+        return {
+            "taskId": self.taskId,
+            "status": self.status,
+            "content": self.content,
+            "output": self.output,
+            "expand": self.expand,
+        }
+
 
 class StreamCard:
     def __init__(
@@ -50,16 +76,20 @@ class StreamCard:
         - `token`  AI助理回调的会话token
         """
         self.__conversation_token = token
-        self.__template_id = "4b6e421f-5300-4ba4-bb0b-0fcea69051f0.schema"
-        self.__stream_data = ""
+        self.__template_id = _TEMPLATE_ID
+        # 流式内容按片段累积，只在需要发送时才拼接，避免每个增量都复制一遍已有内容
+        self.__stream_chunks = []
         self.__title = ""
         self.__buffer_size = 0
         self.__cached_size = 0
+        # 未达到 buffer_size 的增量最多在本地停留 flush_interval 秒，之后由后台任务刷新
+        self.__flush_interval = 0.08
+        self.__flush_task = None
 
         self.__steps_name_list = []
         self.__steps_map = {}
 
-        self.__lock = Lock()
+        self.__lock = asyncio.Lock()
 
         self.__initialized = False
         self.__stream_changed = False
@@ -88,7 +118,7 @@ class StreamCard:
             card_data=CardData(
                 card_data=card_data,
                 template_id=self.__template_id,
-                options={"componentTag": "staticComponent"},
+                options=_STATIC_OPTIONS,
             ),
         )
 
@@ -98,16 +128,16 @@ class StreamCard:
          - `full_content` 全量卡片内容
         """
         self.__stream_changed = True
-        self.__lock.acquire()
-        self.__stream_data = full_content
-        self.__lock.release()
+        self.__cancel_delayed_flush()
+        async with self.__lock:
+            self.__stream_chunks = [full_content]
         card_data = CardData(
             card_data={
                 "key": "result",  # 流式更新，只更新result字段
-                "value": self.__stream_data,
+                "value": self.__stream_text(),
                 "isFinalize": True,  # 因为是全量更新，会结束卡片流式状态
             },
-            options={"componentTag": "streamingComponent"},
+            options=_STREAMING_OPTIONS,
             template_id=self.__template_id,
         )
 
@@ -123,42 +153,66 @@ class StreamCard:
          - `flush` 是否立即刷新，如果设置了buffer_size，又希望更新立即刷新，请设置此参数
         """
         self.__stream_changed = True
-        self.__lock.acquire()
-        delta_size = len(delta_content)
-        self.__stream_data += delta_content
-        self.__cached_size += delta_size
-        self.__lock.release()
+        async with self.__lock:
+            self.__stream_chunks.append(delta_content)
+            self.__cached_size += len(delta_content)
 
         if not flush and self.__cached_size < self.__buffer_size:
+            if self.__flush_task is None:
+                self.__flush_task = asyncio.create_task(self.__delayed_flush())
             return
+        self.__cancel_delayed_flush()
+        self.__flush_stream()
+
+    def __flush_stream(self):
+        """把当前的流式内容作为一帧提交"""
         self.__cached_size = 0
         card_data = CardData(
             card_data={
                 "key": "result",  # 流式更新，只更新result字段
-                "value": self.__stream_data,
+                "value": self.__stream_text(),
                 "isFinalize": False,  # 流式输出中，不能设置为True
             },
-            options={"componentTag": "streamingComponent"},
+            options=_STREAMING_OPTIONS,
             template_id=self.__template_id,
         )
 
-        await reply_service.update_card(
-            conversation_token=self.__conversation_token,
-            card_data=card_data,
-        )
+        # 流式帧交给 reply_service 合并发送，后续的全量更新或结束卡片会先等这些帧发出
+        reply_service.update_card_coalesced(self.__conversation_token, card_data)
+
+    def __stream_text(self) -> str:
+        """拼接当前的流式内容，拼接结果作为唯一片段保留，下次只需追加新片段"""
+        chunks = self.__stream_chunks
+        if len(chunks) > 1:
+            chunks[:] = ["".join(chunks)]
+        return chunks[0] if chunks else ""
+
+    async def __delayed_flush(self):
+        """等待 flush_interval 后刷新缓存的增量，期间到达的增量合并为一帧"""
+        await asyncio.sleep(self.__flush_interval)
+        self.__flush_task = None
+        if self.__cached_size:
+            self.__flush_stream()
+
+    def __cancel_delayed_flush(self):
+        """取消尚未执行的延迟刷新，之后发送的帧已包含全部内容"""
+        if self.__flush_task is not None:
+            self.__flush_task.cancel()
+            self.__flush_task = None
 
     async def finish(self):
         """
         结束卡片流式输出
         """
         self.__stream_changed = True
+        self.__cancel_delayed_flush()
         card_data = CardData(
             card_data={
                 "key": "result",  # 流式更新，只更新result字段
-                "value": self.__stream_data,
+                "value": self.__stream_text(),
                 "isFinalize": True,  # 流式输出中，不能设置为True
             },
-            options={"componentTag": "streamingComponent"},
+            options=_STREAMING_OPTIONS,
             template_id=self.__template_id,
         )
 
@@ -188,13 +242,7 @@ class StreamCard:
         step = _PlanStep(step_name, step_status, step_desc, step_detail, expand)
         self.__steps_name_list.append(step_name)
         self.__steps_map[step_name] = step
-        steps = []
-        for name in self.__steps_name_list:
-            steps.append(self.__steps_map[name])
-        steps_str = json.dumps(steps, default=lambda k: k.__dict__)
-        card_data = {
-            "planList": json.loads(steps_str),
-        }
+        card_data = self._plan_payload()
         await reply_service.reply(
             self.__conversation_token,
             None,
@@ -202,7 +250,7 @@ class StreamCard:
             card_data=CardData(
                 card_data=card_data,
                 template_id=self.__template_id,
-                options={"componentTag": "staticComponent"},
+                options=_STATIC_OPTIONS,
             ),
         )
 
@@ -227,13 +275,7 @@ class StreamCard:
         expand = True
         step = _PlanStep(step_name, step_status, step_desc, step_detail, expand)
         self.__steps_map[step_name] = step
-        steps = []
-        for name in self.__steps_name_list:
-            steps.append(self.__steps_map[name])
-        steps_str = json.dumps(steps, default=lambda k: k.__dict__)
-        card_data = {
-            "planList": json.loads(steps_str),
-        }
+        card_data = self._plan_payload()
         await reply_service.reply(
             self.__conversation_token,
             None,
@@ -241,10 +283,16 @@ class StreamCard:
             card_data=CardData(
                 card_data=card_data,
                 template_id=self.__template_id,
-                options={"componentTag": "staticComponent"},
+                options=_STATIC_OPTIONS,
             ),
         )
 
+    def _plan_payload(self) -> dict:
+        """按创建顺序生成 planList，步骤直接转成字典，由 reply_service 统一编码"""
+        return {
+            "planList": [self.__steps_map[name].to_dict() for name in self.__steps_name_list],
+        }
+
     def update_buffer_size(self, buffer_size: int):
         """
         设置流式输出缓存大小，默认为0，即本地不缓存，每调用一次update_delta，都会调用一次钉钉开放平台API
@@ -267,7 +315,7 @@ class StreamCard:
             card_data=CardData(
                 card_data=card_data,
                 template_id=self.__template_id,
-                options={"componentTag": "staticComponent"},
+                options=_STATIC_OPTIONS,
             ),
         )
 
@@ -278,19 +326,9 @@ class StreamCard:
         if self.__stream_changed:
             return
         self.__stream_changed = True
-        card_data = CardData(
-            card_data={
-                "key": "result",  # 流式更新，只更新result字段
-                "value": "~",
-                "isFinalize": False,  # 流式输出中，不能设置为True
-            },
-            options={"componentTag": "streamingComponent"},
-            template_id=self.__template_id,
-        )
-
         await reply_service.update_card(
             conversation_token=self.__conversation_token,
-            card_data=card_data,
+            card_data=_EMPTY_STREAM_CARD,
         )
 
 
@@ -413,7 +451,5 @@ async def __test_async_main(token: str):
 
 
 if __name__ == "__main__":
-    import asyncio
-
     token = ""
     asyncio.run(__test_async_main(token))
@@ -1,29 +1,136 @@
-import json
 import asyncio
 import time
+import weakref
+from collections import OrderedDict
+from dataclasses import dataclass, asdict
+from functools import lru_cache
 from typing import Any, Dict, Tuple
 
+import orjson
 from dingtalk_stream import GraphRequest, CallbackMessage, AckMessage
 from dingtalk_stream.frames import Headers
-from dingtalk_stream.graph import GraphHandler, GraphResponse
+from dingtalk_stream.graph import GraphHandler
 from loguru import logger
 
 from app.config.settings import settings
 from app.drag.drag_service import *
 from app.service.reply_service import reply_service
 
-from app.utils.stop_watch import Stopwatch
 from app.service.message_context import MessageContext
 from app.agent.agent_manager import AgentManager
+from app.utils.loop_local import LoopLocal
 
 #if len(text_content) == 30:
-#    return self._create_response(call_qa_trace(text_content))
-
-#if len(text_content) == 32:
-#    return self._create_response(call_agent_code(text_content))
+#    return self._create_response(await call_qa_trace(text_content))
+
+# 让 orjson 对标准库 json 不支持的类型抛出 TypeError，而不是自行序列化
+_PASSTHROUGH = orjson.OPT_PASSTHROUGH_DATACLASS | orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_SUBCLASS
+# 转换时 dataclass、datetime 交给 _fallback 处理，与逐层转换的结果保持一致（datetime 仍为 str(dt)）
+_CONVERT = orjson.OPT_PASSTHROUGH_DATACLASS | orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+
+_SCALAR, _SEQUENCE, _MAPPING, _OBJECT = range(4)
+_MISSING = object()
+
+
+def _fallback(obj: Any) -> Any:
+    """orjson 无法直接序列化的对象才会回调到这里，嵌套结构由 orjson 在 C 层遍历"""
+    if hasattr(obj, "text") and hasattr(obj, "type"):
+        # 处理 TextContent 类型
+        return obj.text
+    if hasattr(obj, "__dict__"):
+        # 尝试将对象转换为字典
+        return obj.__dict__
+    # 其他类型转换为字符串
+    return str(obj)
+
+
+@lru_cache(maxsize=256)
+def _kind_of(cls: type) -> int:
+    """按类型缓存分类结果，之后同类型的节点只需一次字典查找"""
+    if cls is type(None) or issubclass(cls, (str, int, float, bool)):
+        return _SCALAR
+    if issubclass(cls, (list, tuple)):
+        return _SEQUENCE
+    if issubclass(cls, dict):
+        return _MAPPING
+    return _OBJECT
+
+
+def _to_serializable(obj: Any) -> Any:
+    """
+    将对象转换为可 JSON 序列化的形式，orjson 无法处理时（如超过 64 位的整数）使用
+    用显式栈代替递归，嵌套很深的工具输出也不会触发 RecursionError
+    """
+    root = [None]
+    stack = [(obj, root, 0)]
+    while stack:
+        value, parent, key = stack.pop()
+        kind = _kind_of(type(value))
+        if kind is _SCALAR:
+            parent[key] = value
+        elif kind is _SEQUENCE:
+            out = [None] * len(value)
+            parent[key] = out
+            stack.extend((item, out, i) for i, item in enumerate(value))
+        elif kind is _MAPPING:
+            # 先按原顺序放入键，出栈顺序不影响结果中键的顺序
+            out = dict.fromkeys(value)
+            parent[key] = out
+            stack.extend((v, out, k) for k, v in value.items())
+        else:
+            text = getattr(value, "text", _MISSING)
+            if text is not _MISSING and hasattr(value, "type"):
+                # 处理 TextContent 类型
+                parent[key] = text
+            elif hasattr(value, "__dict__"):
+                # 尝试将对象转换为字典
+                stack.append((value.__dict__, parent, key))
+            else:
+                # 其他类型转换为字符串
+                parent[key] = str(value)
+    return root[0]
+
+
+@dataclass(slots=True)
+class HandlerStats:
+    """Handler statistics counters"""
+    messages_received: int = 0
+    messages_processed: int = 0
+    errors: int = 0
+    timeouts: int = 0
+    last_message_time: float = 0
+
+
+# 消息体字段 -> MessageContext 字段的映射：(消息体中的键, MessageContext 字段名, 默认值)
+_META_FIELDS = (
+    ("sender_id", "user_id", ""),
+    ("sender_nick", "user_name", "Unknown User"),
+    ("conversation_id", "conversation_id", ""),
+    ("conversation_title", "group_name", ""),
+    ("conversationToken", "conversation_token", ""),
+    ("sender_union_id", "sender_union_id", ""),
+)
 
 
 class MessageCallbackHandler(GraphHandler):
+    # GraphResponse.to_dict() 的结果模板，每次响应只替换 body，不再逐个构建 GraphResponse 对象；
+    # 各 _create_*_response 直接返回 AckMessage.data 的最终结构 {"response": ...}
+    _BASE_RESPONSE_DICT = {
+        "statusLine": {"code": 200, "reasonPhrase": "OK"},
+        "headers": {"Content-Type": "application/json"},
+    }
+    # 空消息的响应内容固定，整个 (code, dict) 元组共享，只会被序列化不会被修改
+    _EMPTY_RESPONSE = (AckMessage.STATUS_OK, {"response": {
+        **_BASE_RESPONSE_DICT,
+        "body": {"status": "empty_message", "text": "No valid text content"},
+    }})
+    _ERROR_RESPONSE_DICT = {
+        "statusLine": {"code": 500, "reasonPhrase": "Internal Server Error"},
+        "headers": {"Content-Type": "application/json"},
+    }
+    # 每个事件循环上缓存的 AgentManager 数量上限
+    _AGENT_POOL_SIZE = 128
+
     def __init__(self, timeout: int = 120):
         """
         Initialize the handler with a message processor
@@ -34,15 +141,19 @@ class MessageCallbackHandler(GraphHandler):
         super().__init__()
         self.timeout = timeout
         self.reply_service = reply_service
-        self.processing_lock = asyncio.Lock()  # ✅ 添加并发控制
+        # 按会话加锁：同一会话内的消息按顺序处理，不同会话之间可以并发；
+        # 没有协程持有的锁会被自动回收
+        self._conversation_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+        # 全局并发上限，避免突发消息同时拉起过多 LLM 请求；每次重连都是新的事件循环，按循环各持有一个
+        self._processing_sems = LoopLocal(lambda: asyncio.Semaphore(settings.MAX_CONCURRENT_MESSAGES))
+        # 按用户复用 AgentManager（LRU），Agent 绑定着事件循环上的 MCP 连接，因此每个事件循环各有一个池
+        self._agent_pools = LoopLocal(OrderedDict)
+        # 后台清理任务的强引用，避免任务在完成前被回收
+        self._cleanup_tasks = set()
+        # 正在处理中的 message_id -> Task，用于合并钉钉的重发消息
+        self._inflight = LoopLocal(dict)
         
-        self.stats = {
-            "messages_received": 0,
-            "messages_processed": 0,
-            "errors": 0,
-            "timeouts": 0,
-            "last_message_time": 0,
-        }
+        self.stats = HandlerStats()
 
     def pre_start(self):
         """Optional: Called before the handler starts"""
@@ -56,135 +167,165 @@ class MessageCallbackHandler(GraphHandler):
         try:
             # Parse incoming message
             graph_request = GraphRequest.from_dict(callback.data)
-            logger.info(f"Processing message: {graph_request.body}")
+            logger.opt(lazy=True).debug("Processing message: {}", lambda: graph_request.body)
 
             # Extract message content and metadata
-            text_content, message_metadata = self._parse_message_content(graph_request.body)
+            text_content, message_metadata = self._parse_body(graph_request.body)
 
             # Skip empty messages
             if not text_content:
                 logger.info("Received empty message, skipping processing")
                 return self._create_empty_response()  # ✅ 直接返回
+
+            # 钉钉未及时收到 ack 时会用相同的 message_id 重发消息，
+            # 重发时如果原消息还在处理中，直接等待那一次的结果，不再重复调用 Agent
+            message_id = callback.headers.message_id
+            inflight = self._inflight.get()
+            pending = inflight.get(message_id) if message_id else None
+            if pending is not None:
+                logger.info(f"Message {message_id} is already being processed, waiting for its result")
+                return await asyncio.shield(pending)
             
             # Update stats
-            self.stats["messages_received"] += 1
-            self.stats["last_message_time"] = time.time()
+            self.stats.messages_received += 1
+            self.stats.last_message_time = time.monotonic()
 
-            # Construct MessageContext
+            # Construct MessageContext，元数据的键已经是 MessageContext 的字段名
             context = MessageContext(
                 content=text_content,
-                user_name=message_metadata["sender_nick"],
-                user_id=message_metadata["sender_id"],
-                sender_union_id=message_metadata["sender_union_id"],
-                is_group_chat=message_metadata["conversation_type"] != "1",
-                group_name=message_metadata["group_name"],
-                conversation_id=message_metadata["conversation_id"],
                 timestamp=int(time.time()),
-                conversation_token=message_metadata["conversation_token"]
+                **message_metadata
             )
 
-            # 使用锁防止并发处理
-            async with self.processing_lock:
-                try:
-                    # Create stop watch for timing
-                    stop_watch = Stopwatch()
-                    stop_watch.start()
-
-                    # 处理消息，添加超时控制
-                    result = await asyncio.wait_for(
-                        self._process_with_agent_manager(context),
-                        timeout=self.timeout
-                    )
-                    
-                    # Update success stats
-                    self.stats["messages_processed"] += 1
-                    logger.info(
-                        f"Finished processing message for {context.user_name}, result: {result}"
-                        f"elapsed: {stop_watch.elapsed():.2f}ms"
-                    )
-                    
-                    return self._create_response(result)  # ✅ 直接返回
-                    
-                except asyncio.TimeoutError:
-                    self.stats["timeouts"] += 1
-                    logger.error(f"Message processing timeout after {self.timeout}s")
-                    return self._create_error_response("Processing timeout")  # ✅ 直接返回
-                    
-                except Exception as e:
-                    self.stats["errors"] += 1
-                    logger.error(f"Error processing message: {str(e)}", exc_info=True)
-                    return self._create_error_response(str(e))  # ✅ 直接返回
+            task = asyncio.ensure_future(self._process_context(context))
+            if message_id:
+                inflight[message_id] = task
+                task.add_done_callback(lambda _: inflight.pop(message_id, None))
+            return await task
 
         except Exception as e:
-            self.stats["errors"] += 1
-            logger.error(f"Error parsing callback message: {str(e)}", exc_info=True)
+            self.stats.errors += 1
+            logger.opt(exception=True).error(f"Error parsing callback message: {str(e)}")
             return self._create_error_response(f"Parse error: {str(e)}")  # ✅ 直接返回
 
+    async def _process_context(self, context: MessageContext) -> Tuple[int, Dict]:
+        """按会话顺序、在并发上限内处理一条消息，返回响应"""
+        # 同一会话的消息依次处理；先排会话锁再占并发名额，排队等待时不占用名额
+        lock = self._conversation_locks.setdefault(context.conversation_id, asyncio.Lock())
+        async with lock, self._processing_sems.get():
+            try:
+                # 记录开始时间，只读一次整数纳秒计数器，不再为每条消息创建 Stopwatch
+                started_ns = time.perf_counter_ns()
+
+                # 处理消息，添加超时控制
+                result = await asyncio.wait_for(
+                    self._process_with_agent_manager(context),
+                    timeout=self.timeout
+                )
+                
+                # Update success stats
+                self.stats.messages_processed += 1
+                elapsed_ms = (time.perf_counter_ns() - started_ns) / 1e6
+                logger.opt(lazy=True).info(
+                    "Finished processing message for {}, result: {} elapsed: {:.2f}ms",
+                    lambda: context.user_name, lambda: result, lambda: elapsed_ms
+                )
+                
+                return self._create_response(result)  # ✅ 直接返回
+                
+            except asyncio.TimeoutError:
+                self.stats.timeouts += 1
+                logger.error(f"Message processing timeout after {self.timeout}s for user {context.user_name}")
+                return self._create_error_response("Processing timeout")  # ✅ 直接返回
+                
+            except Exception as e:
+                self.stats.errors += 1
+                logger.opt(exception=True).error(f"Error processing message: {str(e)}")
+                return self._create_error_response(str(e))  # ✅ 直接返回
+
+
     async def _process_with_agent_manager(self, context: MessageContext) -> Dict[str, Any]:
         """
         使用 AgentManager 处理消息
         简化版本，专注于核心逻辑
         """
-        agent_manager = None
         try:
-            logger.info(
-                f"Processing message from {context.user_name} ({context.user_id}) "
-                f"in {'group' if context.is_group_chat else 'private'} chat"
+            logger.opt(lazy=True).info(
+                "Processing message from {} ({}) in {} chat",
+                lambda: context.user_name, lambda: context.user_id,
+                lambda: "group" if context.is_group_chat else "private"
             )
 
-            # 创建 AgentManager 实例
-            agent_manager = AgentManager(current_user_info=context.to_dict())
+            # 获取该用户复用的 AgentManager 实例
+            agent_manager = self._acquire_agent_manager(context)
+            try:
+                # 超时由 process 中唯一的 wait_for 统一控制，这里不再单独设置超时
+                result = await agent_manager.process_message(context)
+            finally:
+                agent_manager.active_runs -= 1
             
-            # 处理消息，内部添加超时控制
-            result = await asyncio.wait_for(
-                agent_manager.process_message(context),
-                timeout=self.timeout - 5  # 预留5秒给清理
-            )
-            
-            return result.final_output
+            return result.result
 
-        except asyncio.TimeoutError:
-            logger.error(f"AgentManager processing timeout for user {context.user_name}")
-            raise  # 重新抛出，由上层处理
-            
         except Exception as e:
-            logger.error(f"Error in agent manager processing: {str(e)}", exc_info=True)
+            logger.opt(exception=True).error(f"Error in agent manager processing: {str(e)}")
             return {
                 "status": "error",
                 "message": str(e),
                 "error_type": type(e).__name__
             }
-        finally:
-            # 确保资源清理
-            if agent_manager:
-                try:
-                    await asyncio.wait_for(agent_manager.cleanup(), timeout=5)
-                except Exception as cleanup_error:
-                    logger.warning(f"Error during cleanup: {cleanup_error}")
+
+    def _acquire_agent_manager(self, context: MessageContext) -> AgentManager:
+        """
+        从池中取出该用户的 AgentManager，没有则创建，返回前计入 active_runs，调用方用完后需减一
+        实例在消息之间复用，只有被 LRU 淘汰时才清理资源
+        本方法中没有 await，计数加一后到调用方进入 try 之间不会被取消，计数不会泄漏
+        """
+        pool = self._agent_pools.get()
+        agent_manager = pool.get(context.user_id)
+        if agent_manager is not None:
+            pool.move_to_end(context.user_id)
+            agent_manager.update_context(context.to_dict())
+            agent_manager.active_runs += 1
+            return agent_manager
+
+        agent_manager = AgentManager(current_user_info=context.to_dict())
+        agent_manager.active_runs += 1
+        pool[context.user_id] = agent_manager
+        if len(pool) > self._AGENT_POOL_SIZE:
+            # 按 LRU 顺序淘汰第一个空闲实例，正在处理消息的 Agent 不能中途失去 MCP 连接；
+            # 都在忙时暂时超出上限，之后再淘汰
+            idle_user = next((user_id for user_id, manager in pool.items() if not manager.active_runs), None)
+            if idle_user is not None:
+                # 清理放到后台任务里，当前消息不必等待，也不会因当前消息被取消而中断
+                task = asyncio.create_task(self._cleanup_agent_manager(pool.pop(idle_user)))
+                self._cleanup_tasks.add(task)
+                task.add_done_callback(self._cleanup_tasks.discard)
+        return agent_manager
+
+    @staticmethod
+    async def _cleanup_agent_manager(agent_manager: AgentManager) -> None:
+        """清理被淘汰的 AgentManager"""
+        try:
+            await asyncio.wait_for(agent_manager.cleanup(), timeout=5)
+        except Exception as cleanup_error:
+            logger.warning(f"Error during cleanup: {cleanup_error}")
 
     def _create_response(self, result: Any) -> Tuple[int, Dict]:
         """根据结果类型创建适当的响应"""
         if not result:
             return self._create_empty_response()
 
-        response = self._create_base_response()
-
         if isinstance(result, dict) and "tool_name" in result:
-            response.body = self._create_tool_response(result)
+            body = self._create_tool_response(result)
         else:
-            response.body = self._create_text_response(result)
+            body = self._create_text_response(result)
 
-        logger.info(f"Response: {response.to_dict()}")
+        response = {**self._BASE_RESPONSE_DICT, "body": body}
+        # 响应可能包含很大的工具输出，完整内容只在 DEBUG 级别序列化输出，INFO 只记录字段
+        logger.info(f"Response ready, body keys: {list(body)}")
+        logger.opt(lazy=True).debug("Response: {}", lambda: orjson.dumps(response, default=str).decode())
 
-        return AckMessage.STATUS_OK, response.to_dict()
-    
-    def _create_base_response(self) -> GraphResponse:
-        """创建带有通用设置的基础响应"""
-        response = GraphResponse()
-        response.status_line.code = 200
-        response.status_line.reason_phrase = "OK"
-        response.headers["Content-Type"] = "application/json"
-        return response
+        return AckMessage.STATUS_OK, {"response": response}
 
     def _create_tool_response(self, result: Dict) -> Dict:
         """创建工具执行结果的响应"""
@@ -203,19 +344,21 @@ class MessageCallbackHandler(GraphHandler):
 
     def _create_empty_response(self) -> Tuple[int, Dict]:
         """创建空消息的响应"""
-        response = self._create_base_response()
-        response.body = {"status": "empty_message", "text": "No valid text content"}
-        return AckMessage.STATUS_OK, response.to_dict()
+        return self._EMPTY_RESPONSE
 
     def _create_error_response(self, error_message: str) -> Tuple[int, Dict]:
         """创建错误响应"""
-        response = self._create_base_response()
-        response.status_line.code = 500
-        response.status_line.reason_phrase = "Internal Server Error"
-        response.body = {"error": error_message}
-        return AckMessage.STATUS_SYSTEM_EXCEPTION, response.to_dict()
+        return AckMessage.STATUS_SYSTEM_EXCEPTION, {
+            "response": {**self._ERROR_RESPONSE_DICT, "body": {"error": error_message}}
+        }
 
-    def _parse_message_content(self, body: Any) -> Tuple[str, Dict[str, Any]]:
+    def _parse_body(self, body: Any) -> Tuple[str, Dict[str, Any]]:
+        """解析消息体，只解析一次，之后都使用解析得到的字典"""
+        if isinstance(body, (str, bytes)):
+            body = orjson.loads(body)
+        return self._parse_message_content(body)
+
+    def _parse_message_content(self, body: Dict[str, Any]) -> Tuple[str, Dict[str, Any]]:
         """
         Data format example:
         {
@@ -247,43 +390,16 @@ class MessageCallbackHandler(GraphHandler):
         }
         """
         try:
-            # Parse body if it's a string
-            if isinstance(body, str):
-                body = json.loads(body)
-
-            msg_type = json.loads(body.get("msgType")).get("msgType")
-
             # Extract text content
             text_content = body.get("input", "").strip()
+            # 空消息直接返回，不再构建元数据
+            if not text_content:
+                return "", {}
 
-            # Extract org_id from multiple possible locations
-            org_id = body.get("orgId") or body.get("org_id")
-            request_id = None
-            if not org_id:
-                scenario_ctx = body.get("scenarioContext")
-                if scenario_ctx:
-                    try:
-                        if isinstance(scenario_ctx, str):
-                            scenario_ctx_obj = json.loads(scenario_ctx)
-                        else:
-                            scenario_ctx_obj = scenario_ctx
-                        org_id = scenario_ctx_obj.get("orgId")
-                        request_id = scenario_ctx_obj.get("requestId")
-                    except Exception as e:
-                        logger.warning(f"Failed to parse scenarioContext for orgId: {e}")
-
-            # Extract metadata
-            metadata = {
-                "msg_type": msg_type,
-                "sender_id": body.get("sender_id", ""),
-                "sender_nick": body.get("sender_nick", "Unknown User"),
-                "conversation_id": body.get("conversation_id", ""),
-                "conversation_type": body.get("conversation_type", "1"),
-                "group_name": body.get("conversation_title", ""),
-                "conversation_token": body.get("conversationToken", ""),
-                "sender_union_id": body.get("sender_union_id", ""),
-                "request_id": request_id
-            }
+            # Extract metadata, keyed by MessageContext field names
+            body_get = body.get
+            metadata = {field: body_get(key, default) for key, field, default in _META_FIELDS}
+            metadata["is_group_chat"] = body_get("conversation_type", "1") != "1"
 
             return text_content, metadata
 
@@ -296,44 +412,35 @@ class MessageCallbackHandler(GraphHandler):
         Process a message from DingTalk stream and return an AckMessage
         This method follows the dingtalk_stream library's expected behavior
         """
-        code, response_dict = await self.process(callback)
+        code, ack_data = await self.process(callback)
         ack_message = AckMessage()
         ack_message.code = code
         ack_message.headers.message_id = callback.headers.message_id
         ack_message.headers.content_type = Headers.CONTENT_TYPE_APPLICATION_JSON
-        ack_message.data = {"response": response_dict}
+        ack_message.data = ack_data
         return ack_message
 
 
     def get_stats(self) -> Dict[str, Any]:
         """Get handler statistics"""
-        return self.stats.copy()
+        return asdict(self.stats)
 
     def reset_stats(self) -> None:
         """Reset all statistics counters except last_message_time"""
-        self.stats.update({
-            "messages_received": 0, 
-            "messages_processed": 0, 
-            "errors": 0,
-            "timeouts": 0
-        })
+        self.stats = HandlerStats(last_message_time=self.stats.last_message_time)
 
     def _make_json_serializable(self, obj):
         """将对象转换为可 JSON 序列化的形式"""
-        if obj is None:
-            return None
-        elif isinstance(obj, (str, int, float, bool)):
+        try:
+            # 只含基本类型、列表、字典时，orjson 在 C 层一次校验完即可原样返回；
+            # dataclass、datetime 等标准库 json 无法处理的类型会抛出 TypeError，改由 orjson 配合 _fallback 转换
+            orjson.dumps(obj, option=_PASSTHROUGH)
             return obj
-        elif isinstance(obj, (list, tuple)):
-            return [self._make_json_serializable(item) for item in obj]
-        elif isinstance(obj, dict):
-            return {k: self._make_json_serializable(v) for k, v in obj.items()}
-        elif hasattr(obj, "text") and hasattr(obj, "type"):
-            # 处理 TextContent 类型
-            return obj.text
-        elif hasattr(obj, "__dict__"):
-            # 尝试将对象转换为字典
-            return self._make_json_serializable(obj.__dict__)
-        else:
-            # 其他类型转换为字符串
-            return str(obj)
\ No newline at end of file
+        except TypeError:
+            pass
+
+        try:
+            return orjson.loads(orjson.dumps(obj, default=_fallback, option=_CONVERT))
+        except TypeError:
+            # orjson 不支持超过 64 位的整数等情况，回退到逐层转换
+            return _to_serializable(obj)
@@ -1,7 +1,10 @@
 """
 钉钉认证模块
 """
+import asyncio
+import threading
 import time
+import weakref
 from loguru import logger
 
 from alibabacloud_dingtalk.oauth2_1_0.client import Client as dingtalkoauth2_1_0Client
@@ -10,6 +13,15 @@ from alibabacloud_dingtalk.oauth2_1_0 import models as dingtalkoauth_2__1__0_mod
 from alibabacloud_tea_util.client import Client as UtilClient
 
 from app.config.settings import settings
+from app.utils.api_error import log_api_error
+
+# 刷新失败后的退避时间（秒），连续失败时翻倍，直到上限
+_REFRESH_BACKOFF_BASE = 5
+_REFRESH_BACKOFF_MAX = 60
+
+
+class DingtalkAuthError(Exception):
+    """无法获取可用的访问令牌"""
 
 
 class DingtalkAuth:
@@ -27,8 +39,18 @@ class DingtalkAuth:
         self.app_access_token = None
         self.app_expires_in = 0
         self.app_last_refresh_time = 0
+        # 同一时间只允许一个线程刷新应用令牌，避免令牌过期时并发请求同时打到 OAuth 接口
+        self._app_lock = threading.Lock()
+        # 后台定时刷新，令牌进入提前刷新窗口前就已经换新，调用方不会碰上同步刷新
+        self._app_timer = None
+        # 刷新失败后在 _app_retry_at 之前不再请求 OAuth 接口
+        self._app_failures = 0
+        self._app_retry_at = 0.0
+        # 每个事件循环上正在进行的异步刷新，并发的调用方共同等待同一次刷新
+        self._refresh_futures: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Future]" = weakref.WeakKeyDictionary()
         
-        self.client = self._create_client()
+        # OAuth 客户端在第一次刷新令牌时才创建，只导入模块或令牌仍有效时不必初始化 SDK
+        self.client = None
 
     def _create_client(self) -> dingtalkoauth2_1_0Client:
         """
@@ -48,11 +70,46 @@ class DingtalkAuth:
 
         Returns:
             str: 应用访问令牌
+
+        Raises:
+            DingtalkAuthError: 刷新失败且没有仍在有效期内的旧令牌
         """
-        if self.app_access_token and self._is_app_token_valid():
-            return self.app_access_token
+        token = self._cached_app_token()
+        if token:
+            return token
+
+        with self._app_lock:
+            # 等锁期间其他线程可能已经刷新完成，直接复用刷新结果
+            token = self._cached_app_token()
+            if token:
+                return token
+            if time.monotonic() < self._app_retry_at:
+                raise DingtalkAuthError("应用访问令牌已过期，刷新退避中")
+            return self._refresh_app_token()
+
+    async def get_app_access_token_async(self) -> str:
+        """
+        在事件循环中获取企业应用访问令牌
+        刷新是同步网络请求，放到线程池中执行；同一事件循环上的并发调用只发起一次刷新
 
-        return self._refresh_app_token()
+        Returns:
+            str: 应用访问令牌
+
+        Raises:
+            DingtalkAuthError: 刷新失败且没有仍在有效期内的旧令牌
+        """
+        token = self._cached_app_token()
+        if token:
+            return token
+
+        loop = asyncio.get_running_loop()
+        future = self._refresh_futures.get(loop)
+        if future is None:
+            future = loop.run_in_executor(None, self.get_app_access_token)
+            self._refresh_futures[loop] = future
+            future.add_done_callback(lambda _: self._refresh_futures.pop(loop, None))
+        # 某个调用方被取消时不影响其他等待同一次刷新的调用方
+        return await asyncio.shield(future)
 
     def _is_app_token_valid(self) -> bool:
         """
@@ -65,9 +122,24 @@ class DingtalkAuth:
             return False
 
         # 检查是否过期（提前5分钟刷新）
-        current_time = time.time()
+        current_time = time.monotonic()
         return current_time < (self.app_last_refresh_time + self.app_expires_in - 300)
 
+    def _is_app_token_alive(self) -> bool:
+        """令牌是否仍在真实有效期内（不含提前刷新的5分钟）"""
+        return bool(self.app_access_token) and time.monotonic() < self.app_last_refresh_time + self.app_expires_in
+
+    def _cached_app_token(self):
+        """
+        返回无需刷新即可使用的令牌：未进入提前刷新窗口的令牌，
+        或刷新退避期间仍在真实有效期内的旧令牌；都没有时返回 None
+        """
+        if self._is_app_token_valid():
+            return self.app_access_token
+        if time.monotonic() < self._app_retry_at and self._is_app_token_alive():
+            return self.app_access_token
+        return None
+
     def _refresh_app_token(self) -> str:
         """
         刷新应用访问令牌
@@ -81,19 +153,55 @@ class DingtalkAuth:
                 app_secret=settings.DINGTALK_CLIENT_SECRET
             )
 
+            if self.client is None:
+                self.client = self._create_client()
             response = self.client.get_access_token(request)
             if response.body:
                 self.app_access_token = response.body.access_token
                 self.app_expires_in = response.body.expire_in
-                self.app_last_refresh_time = time.time()
+                self.app_last_refresh_time = time.monotonic()
+                self._app_failures = 0
+                self._app_retry_at = 0.0
+                self._schedule_app_refresh()
                 return self.app_access_token
         except Exception as e:
-            if hasattr(e, 'code') and hasattr(e, 'message'):
-                logger.error(f"获取应用访问令牌失败: {e.code} - {e.message}")
-            else:
-                logger.error(f"获取应用访问令牌时发生错误: {str(e)}")
+            log_api_error("获取应用访问令牌失败", e)
+
+        # 刷新失败后退避一段时间，期间的调用方不再各自请求 OAuth 接口
+        self._app_failures += 1
+        backoff = min(_REFRESH_BACKOFF_BASE * 2 ** (self._app_failures - 1), _REFRESH_BACKOFF_MAX)
+        self._app_retry_at = time.monotonic() + backoff
+
+        # 旧令牌仍在真实有效期内时继续使用（提前5分钟刷新，通常仍然可用），否则抛出异常
+        if self._is_app_token_alive():
+            logger.warning(f"刷新应用访问令牌失败，{backoff}s 内继续使用旧令牌")
+            return self.app_access_token
+        raise DingtalkAuthError("获取应用访问令牌失败")
+
+    def _schedule_app_refresh(self):
+        """
+        在令牌进入提前刷新窗口前1分钟安排一次后台刷新
+        后台刷新失败时不再重试，由 get_app_access_token 的有效期检查兜底
+        """
+        if self._app_timer is not None:
+            self._app_timer.cancel()
+        delay = max(self.app_expires_in - 360, 60)
+        self._app_timer = threading.Timer(delay, self._background_refresh_app_token)
+        self._app_timer.daemon = True
+        self._app_timer.start()
+
+    def _background_refresh_app_token(self):
+        with self._app_lock:
+            try:
+                self._refresh_app_token()
+            except DingtalkAuthError:
+                # 失败已记录，之后由 get_app_access_token 按退避时间重试
+                pass
+
 
-        return ""
+# 进程内共用一个认证对象，令牌缓存、刷新锁和后台刷新定时器都只有一份
+_auth_instance = None
+_auth_lock = threading.Lock()
 
 
 def get_auth() -> DingtalkAuth:
@@ -103,4 +211,9 @@ def get_auth() -> DingtalkAuth:
     Returns:
         DingtalkAuth: 认证对象
     """
-    return DingtalkAuth()
\ No newline at end of file
+    global _auth_instance
+    if _auth_instance is None:
+        with _auth_lock:
+            if _auth_instance is None:
+                _auth_instance = DingtalkAuth()
+    return _auth_instance
\ No newline at end of file
@@ -8,6 +8,7 @@ This module provides a robust implementation of DingTalk's streaming API client
 - Graceful shutdown
 """
 
+import asyncio
 import threading
 import time
 from typing import Dict, Any
@@ -16,10 +17,12 @@ from dataclasses import dataclass
 from dingtalk_stream import DingTalkStreamClient, Credential
 from loguru import logger
 
+from app.agent.doc2bot_agent import close_shared_doc2bot_mcp
 from app.config.settings import settings
+from app.service.reply_service import reply_service
 from .callback_handler import MessageCallbackHandler
 
-@dataclass
+@dataclass(slots=True)
 class ConnectionStats:
     """Connection statistics data class for monitoring client health"""
     connection_attempts: int = 0
@@ -39,11 +42,14 @@ class DingTalkStreamManager:
         
         """
         self.stream_client = None
-        self.stop_event = threading.Event()
+        # asyncio.Event 需要在运行中的事件循环上创建，延迟到 start() 中创建
+        self.stop_event = None
+        # 健康监控只发出重连信号，由客户端所在的事件循环自己关闭连接
+        self.force_reconnect_event = threading.Event()
         self.reconnect_interval = 5  # Initial reconnect interval (seconds)
         self.max_reconnect_interval = 60  # Maximum reconnect interval (seconds)
-        self.client_thread = None
-        self.health_monitor_thread = None
+        self.reconnect_task = None
+        self.health_monitor_task = None
         self.handler = None
 
         # Health monitoring settings
@@ -57,14 +63,16 @@ class DingTalkStreamManager:
     def start(self) -> None:
         """
         启动钉钉流客户端，包含重连逻辑和健康监控
+        需要在事件循环中调用，重连和健康监控任务都运行在该事件循环上
         """
 
+        self.stop_event = asyncio.Event()
         try:
             self._initialize_client()
-            self._start_monitoring_threads()
+            self._start_background_tasks()
             self._update_connection_stats()
         except Exception as e:
-            logger.error(f"启动钉钉流客户端失败: {str(e)}", exc_info=True)
+            logger.opt(exception=True).error(f"启动钉钉流客户端失败: {str(e)}")
             raise
 
     def _initialize_client(self) -> None:
@@ -81,29 +89,31 @@ class DingTalkStreamManager:
         self.stream_client.register_callback_handler(stream_topic, self.handler)
         
 
-    def _start_monitoring_threads(self) -> None:
-        """启动监控线程"""
-        self.client_thread = threading.Thread(
-            target=self._start_client_with_reconnection,
-            daemon=True,
-            name="DingTalkStreamThread"
+    def _start_background_tasks(self) -> None:
+        """在当前事件循环上启动重连和健康监控任务"""
+        loop = asyncio.get_running_loop()
+        self.reconnect_task = loop.create_task(
+            self._run_with_reconnection(),
+            name="DingTalkStreamReconnect"
         )
-        self.client_thread.start()
-
-        self.health_monitor_thread = threading.Thread(
-            target=self._monitor_connection_health,
-            daemon=True,
+        # 健康监控只是定时比较时间戳，作为调用方事件循环上的任务运行，不再单独占用一个线程
+        self.health_monitor_task = loop.create_task(
+            self._monitor_connection_health(),
             name="DingTalkHealthMonitor"
         )
-        self.health_monitor_thread.start()
 
     def _update_connection_stats(self) -> None:
         """更新连接统计信息"""
-        self.stats.last_connection_time = time.time()
+        self.stats.last_connection_time = time.monotonic()
         self.is_healthy = True
 
-    def _start_client_with_reconnection(self) -> None:
-        """启动客户端，包含失败时的自动重连"""
+    async def _run_with_reconnection(self) -> None:
+        """
+        启动客户端，包含失败时的自动重连
+        dingtalk_stream 建立连接时会同步调用 requests，不能直接跑在主事件循环上，
+        因此每次连接通过 to_thread 放到工作线程里用独立的事件循环运行
+        断线重连由 start() 内部的循环负责，这里的退避只在 start() 本身意外退出时生效
+        """
         reconnect_interval = self.reconnect_interval
 
         while not self.stop_event.is_set():
@@ -111,7 +121,7 @@ class DingTalkStreamManager:
                 self.stats.connection_attempts += 1
                 logger.info(f"启动钉钉流客户端连接 (尝试 #{self.stats.connection_attempts})...")
 
-                self.stream_client.start_forever()
+                await asyncio.to_thread(asyncio.run, self._run_client(self.stream_client))
 
                 if self.stop_event.is_set():
                     logger.info("钉钉流客户端正常停止")
@@ -125,32 +135,72 @@ class DingTalkStreamManager:
                     break
 
                 self.is_healthy = False
-                logger.error(f"钉钉流客户端错误: {str(e)}", exc_info=True)
+                logger.opt(exception=True).error(f"钉钉流客户端错误: {str(e)}")
 
             if self.stop_event.is_set():
                 break
 
             self.stats.reconnections += 1
             logger.info(f"{reconnect_interval} 秒后重连 (尝试 #{self.stats.reconnections})...")
-            
-            if self.stop_event.wait(reconnect_interval):
+
+            try:
+                await asyncio.wait_for(self.stop_event.wait(), timeout=reconnect_interval)
                 break
+            except asyncio.TimeoutError:
+                pass
 
             reconnect_interval = min(reconnect_interval * 2, self.max_reconnect_interval)
 
-    def _monitor_connection_health(self) -> None:
+    async def _run_client(self, client: DingTalkStreamClient) -> None:
+        """在工作线程自己的事件循环上运行连接，同时监听停止和强制重连信号"""
+        client_task = asyncio.create_task(client.start())
+        watcher = asyncio.create_task(self._watch_client(client, client_task))
+        try:
+            await client_task
+        except asyncio.CancelledError:
+            pass
+        finally:
+            watcher.cancel()
+            # 事件循环随本次连接一起结束，关闭该循环上的共享 MCP 子进程
+            await close_shared_doc2bot_mcp()
+
+    async def _watch_client(self, client: DingTalkStreamClient, client_task: asyncio.Task) -> None:
+        """
+        收到停止信号后取消客户端任务；收到强制重连信号后关闭当前 websocket，
+        客户端的 start() 会在同一个事件循环上重新建立连接
+        """
+        while not client_task.done():
+            if self.stop_event.is_set():
+                # start() 会吞掉第一次取消并进入 sleep，持续取消直到任务真正结束
+                client_task.cancel()
+            elif self.force_reconnect_event.is_set():
+                self.force_reconnect_event.clear()
+                websocket = client.websocket
+                if websocket is not None:
+                    try:
+                        await websocket.close()
+                    except Exception as e:
+                        logger.error(f"关闭无响应连接时出错: {str(e)}")
+            await asyncio.sleep(0.5)
+
+    def _last_message_time(self) -> float:
+        """处理器最近一次收到消息的时间"""
+        return self.handler.stats.last_message_time if self.handler else 0
+
+    async def _monitor_connection_health(self) -> None:
         """监控钉钉流连接的健康状态"""
         while not self.stop_event.is_set():
             try:
                 if self.handler:
-                    last_message_time = self.handler.stats.get("last_message_time", 0)
-                    current_time = time.time()
+                    # 收到消息或成功发出卡片都说明连接仍然可用，任一方向有活动就不触发重连
+                    last_activity_time = max(self._last_message_time(), reply_service.last_outbound_time)
+                    current_time = time.monotonic()
 
-                    if last_message_time > 0:
-                        time_since_last_message = current_time - last_message_time
+                    if last_activity_time > 0:
+                        time_since_last_activity = current_time - last_activity_time
 
-                        if time_since_last_message > self.connection_timeout:
-                            logger.warning(f"{time_since_last_message:.1f} 秒未收到消息，连接可能已断开")
+                        if time_since_last_activity > self.connection_timeout:
+                            logger.warning(f"{time_since_last_activity:.1f} 秒没有收发消息，连接可能已断开")
                             self.is_healthy = False
                             self._force_reconnect()
                         else:
@@ -162,17 +212,13 @@ class DingTalkStreamManager:
             except Exception as e:
                 logger.error(f"健康监控出错: {str(e)}")
 
-            if self.stop_event.wait(self.health_check_interval):
-                break
+            await asyncio.sleep(self.health_check_interval)
 
     def _force_reconnect(self) -> None:
         """强制重连客户端"""
         if self.stream_client and not self.stop_event.is_set():
             logger.info("由于不活跃，强制重连")
-            try:
-                self.stream_client.stop()
-            except Exception as e:
-                logger.error(f"停止无响应客户端时出错: {str(e)}")
+            self.force_reconnect_event.set()
 
     def stop(self) -> None:
         """优雅地停止钉钉流客户端"""
@@ -181,23 +227,15 @@ class DingTalkStreamManager:
             return
 
         logger.info("正在停止钉钉流客户端...")
+        # 重连任务在退避等待中会直接退出，连接中的工作线程由 _watch_client 取消客户端后结束
         self.stop_event.set()
+        self._cancel_health_monitor()
+        self._reset_client_state()
 
-        try:
-            self.stream_client.close()
-            logger.info("已发送钉钉流客户端关闭命令")
-        except Exception as e:
-            logger.error(f"关闭钉钉流客户端时出错: {str(e)}")
-        finally:
-            self._join_threads()
-            self._reset_client_state()
-
-    def _join_threads(self) -> None:
-        """等待所有线程结束"""
-        if self.client_thread and self.client_thread.is_alive():
-            self.client_thread.join(timeout=5)
-        if self.health_monitor_thread and self.health_monitor_thread.is_alive():
-            self.health_monitor_thread.join(timeout=5)
+    def _cancel_health_monitor(self) -> None:
+        """取消健康监控任务"""
+        if self.health_monitor_task and not self.health_monitor_task.done():
+            self.health_monitor_task.cancel()
 
     def _reset_client_state(self) -> None:
         """重置客户端状态"""
@@ -205,6 +243,10 @@ class DingTalkStreamManager:
         self.handler = None
         self.is_healthy = False
 
+    def _messages_processed(self) -> int:
+        """处理器已处理的消息数，直接读取计数器，不复制整个统计字典"""
+        return self.handler.stats.messages_processed if self.handler else 0
+
     def get_status(self) -> Dict[str, Any]:
         """获取客户端状态"""
         return {
@@ -212,14 +254,14 @@ class DingTalkStreamManager:
             "uptime": self.stats.uptime,
             "connection_attempts": self.stats.connection_attempts,
             "reconnections": self.stats.reconnections,
-            "messages_processed": self.stats.messages_processed,
-            "last_message_time": self.stats.last_message_time
+            "messages_processed": self._messages_processed(),
+            "last_message_time": self._last_message_time()
         }
 
     def _calculate_message_rate(self) -> float:
         """计算消息处理速率"""
         if self.stats.uptime > 0:
-            return self.stats.messages_processed / self.stats.uptime
+            return self._messages_processed() / self.stats.uptime
         return 0.0
 
 
@@ -1,8 +1,8 @@
 # !/usr/bin/env python
-import json
 import argparse
 import logging
 import os
+import orjson
 from dingtalk_stream import AckMessage
 import dingtalk_stream
 from app.drag.drag_service import *
@@ -35,10 +35,20 @@ def define_options():
     return options
 
 
-# rs = call_qa_trace(input)
-# response.body = json.dumps(rs, ensure_ascii=False)
+# rs = await call_qa_trace(input)
+# response.body = orjson.dumps(rs).decode()
 
 class WeatherHandler(dingtalk_stream.GraphHandler):
+    # 固定的天气响应体，导入时序列化一次
+    _STATIC_BODY = orjson.dumps({
+        'location': '杭州',
+        'dateStr': '2024-10-24',
+        'text': '晴天',
+        'temperature': 22,
+        'humidity': 65,
+        'wind_direction': '东南风'
+    }).decode()
+
     def __init__(self, logger: logging.Logger = None):
         super(dingtalk_stream.GraphHandler, self).__init__()
         if logger:
@@ -47,7 +57,7 @@ class WeatherHandler(dingtalk_stream.GraphHandler):
     async def process(self, callback: dingtalk_stream.CallbackMessage):
         request = dingtalk_stream.GraphRequest.from_dict(callback.data)
         self.logger.info('incoming request, method=%s, uri=%s', request.request_line.method, request.request_line.uri)
-        message = json.loads(request.body)
+        message = orjson.loads(request.body)
         input = message['input']
 
         response = dingtalk_stream.GraphResponse()
@@ -55,14 +65,7 @@ class WeatherHandler(dingtalk_stream.GraphHandler):
         response.status_line.reason_phrase = 'OK'
         response.headers['Content-Type'] = 'application/json'
 
-        response.body = json.dumps({
-            'location': '杭州',
-            'dateStr': '2024-10-24',
-            'text': '晴天',
-            'temperature': 22,
-            'humidity': 65,
-            'wind_direction': '东南风'
-        }, ensure_ascii=False)
+        response.body = self._STATIC_BODY
 
         # 3. 直接返回成功状态
         return AckMessage.STATUS_OK, {"status": "processing"}
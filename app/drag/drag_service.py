@@ -1,20 +1,33 @@
-import requests
+import httpx
+import orjson
 from loguru import logger
 
+from app.utils.loop_local import LoopLocal
+
 # 可提取为配置文件或环境变量
 QA_TRACE_URL = "https://pre-lippi-doc2bot.dingtalk.com/qa/trace"
 
-def call_qa_trace(trace_id):
-    response = requests.post(QA_TRACE_URL, json={"traceId": trace_id})
-    result = response.json()
-    if 'retrievalList' in result['result']:
-        result['result']['retrievalList'] = [
-            {'content': f"标题:{item.get('name', '')} 答案:{item.get('content', '')}", 'score': item.get('score', 0)}
-            for item in result['result']['retrievalList']]
-    # 可以添加日志记录用于调试
-    logger.info(f"处理后的问答明细: {result}")
-    return result
 
-def call_agent_code(agent_code):
-    return agent_code
+def _create_http_client() -> httpx.AsyncClient:
+    """创建问答明细接口使用的异步客户端，保持长连接"""
+    return httpx.AsyncClient(
+        headers={"Content-Type": "application/json"},
+        timeout=httpx.Timeout(10.0, connect=3.0),
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=32, keepalive_expiry=60)
+    )
 
+# 复用连接池，避免每次调用都重新建立 TCP 和 TLS 连接；连接绑定事件循环，按循环各持有一个
+_clients = LoopLocal(_create_http_client)
+
+async def call_qa_trace(trace_id):
+    response = await _clients.get().post(QA_TRACE_URL, content=orjson.dumps({"traceId": trace_id}))
+    result = orjson.loads(response.content)
+    trace = result['result']
+    retrieval_list = trace.get('retrievalList')
+    if retrieval_list is not None:
+        trace['retrievalList'] = [
+            {'content': f"标题:{item.get('name', '')} 答案:{item.get('content', '')}", 'score': item.get('score', 0)}
+            for item in retrieval_list]
+    # 明细可能很大，只在 DEBUG 级别下才格式化
+    logger.opt(lazy=True).debug("处理后的问答明细: {}", lambda: result)
+    return result
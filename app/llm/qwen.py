@@ -1,21 +1,37 @@
-from openai import OpenAI
-from typing import List, Dict, Any
-import os
+import asyncio
+from typing import List, Dict, Any, AsyncIterator
 
+import httpx
+import orjson
+from openai import AsyncOpenAI
+
+from app.utils.loop_local import LoopLocal
+
+# 固定的请求头，模块加载时构建一次，由 http_client 附加到每个请求
+_QWEN_HEADERS = httpx.Headers([
+    ("productCode", "DING_APP_STORE"),
+    ("module", "qwen3-235b"),
+])
 
 class QwenClient:
     def __init__(self):
         # 初始化OpenAI客户端
-        self.client = OpenAI(
+        self.client = AsyncOpenAI(
             base_url="https://aipaas.dingtalk.alibaba-inc.com/v1",
             api_key="dummy-key",  # 钉钉API不需要实际的OpenAI密钥
-            default_headers={
-                "productCode": "DING_APP_STORE",
-                "module": "qwen3-235b"
-            }
+            http_client=httpx.AsyncClient(
+                headers=_QWEN_HEADERS,
+                limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+                timeout=60
+            )
         )
 
-    def chat_stream(self, messages: List[Dict[str, str]]) -> Any:
+    @classmethod
+    def get(cls) -> "QwenClient":
+        """获取当前事件循环共享的 QwenClient 实例，首次调用时创建，必须在事件循环中调用"""
+        return _qwen_clients.get()
+
+    async def chat_stream(self, messages: List[Dict[str, str]]) -> Any:
         """
         使用流式方式与通义千问模型对话
 
@@ -26,7 +42,7 @@ class QwenClient:
             流式响应对象
         """
         try:
-            return self.client.chat.completions.create(
+            return await self.client.chat.completions.create(
                 model="qwen3-235b",
                 messages=messages,
                 stream=True
@@ -35,10 +51,40 @@ class QwenClient:
             print(f"错误: {str(e)}")
             return None
 
+    async def chat_stream_text(self, messages: List[Dict[str, str]]) -> AsyncIterator[str]:
+        """
+        流式对话，只逐段返回回复文本
+        直接解析原始 SSE 行并只取 delta.content，不为每个分片构建 Pydantic 模型，
+        没有内容的分片（思考、保活）直接跳过
+
+        Args:
+            messages: 对话历史，格式为[{"role": "user/assistant", "content": "内容"}]
+        """
+        async with self.client.chat.completions.with_streaming_response.create(
+            model="qwen3-235b",
+            messages=messages,
+            stream=True
+        ) as response:
+            async for line in response.iter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[5:].strip()
+                if data == "[DONE]":
+                    break
+                choices = orjson.loads(data).get("choices")
+                if choices:
+                    content = choices[0].get("delta", {}).get("content")
+                    if content:
+                        yield content
+
+
+# 异步客户端的连接绑定事件循环，同一事件循环内复用一个实例
+_qwen_clients = LoopLocal(QwenClient)
 
-def main():
-    # 创建客户端实例
-    client = QwenClient()
+
+async def main():
+    # 获取客户端实例
+    client = QwenClient.get()
 
     # 测试对话历史
     messages = [
@@ -51,16 +97,13 @@ def main():
     print("AI: ", end="", flush=True)
 
     # 获取流式响应
-    stream = client.chat_stream(messages)
-    if stream:
-        try:
-            for chunk in stream:
-                if chunk.choices[0].delta.content is not None:
-                    print(chunk.choices[0].delta.content, end="", flush=True)
-            print()  # 最后打印换行
-        except Exception as e:
-            print(f"\n处理响应时出错: {str(e)}")
+    try:
+        async for content in client.chat_stream_text(messages):
+            print(content, end="", flush=True)
+        print()  # 最后打印换行
+    except Exception as e:
+        print(f"\n处理响应时出错: {str(e)}")
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    asyncio.run(main())
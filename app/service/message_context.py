@@ -5,9 +5,9 @@ from typing import Optional
 from dataclasses import dataclass
 from app.core.stream_card import StreamCard
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class MessageContext:
-    """Data class for message context information"""
+    """Data class for message context information, immutable once built"""
     # 用户相关属性
     user_name: str
     user_id: str # Typically senderId from DingTalk
@@ -23,16 +23,18 @@ class MessageContext:
     @classmethod
     def from_dingtalk_message(cls, message: dict) -> 'MessageContext':
         """Create MessageContext from DingTalk message"""
+        get = message.get
+        text = get("text")
         return cls(
-            user_name=message.get("senderNick", "Unknown"),
-            user_id=message.get("senderId", ""),
-            sender_union_id=message.get("senderUnionId"),
-            content=message.get("text", {}).get("content", ""),
-            is_group_chat=message.get("conversationType") == "2",
-            group_name=message.get("conversationTitle"),
-            conversation_id=message.get("conversationId"),
-            timestamp=message.get("createAt"),
-            conversation_token=message.get("conversationToken"),
+            user_name=get("senderNick", "Unknown"),
+            user_id=get("senderId", ""),
+            sender_union_id=get("senderUnionId"),
+            content=text.get("content", "") if text else "",
+            is_group_chat=get("conversationType") == "2",
+            group_name=get("conversationTitle"),
+            conversation_id=get("conversationId"),
+            timestamp=get("createAt"),
+            conversation_token=get("conversationToken"),
         )
 
     def to_dict(self) -> dict:
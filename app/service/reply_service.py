@@ -2,17 +2,39 @@
 DingTalk message reply service
 """
 from typing import Optional, Dict, Any
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from enum import Enum
-import json
+import asyncio
+import time
 
-from alibabacloud_dingtalk.ai_interaction_1_0.client import Client as DingTalkAIClient
-from alibabacloud_tea_openapi import models as open_api_models
-from alibabacloud_dingtalk.ai_interaction_1_0 import models as dingtalk_models
-from alibabacloud_tea_util import models as util_models
+import httpx
+import orjson
 from loguru import logger
 
 from app.dingtalk.dingtalk_auth import get_auth
+from app.utils.api_error import log_api_error
+from app.utils.loop_local import LoopLocal
+
+DINGTALK_API_BASE_URL = "https://api.dingtalk.com"
+
+
+class DingTalkAPIError(Exception):
+    """DingTalk OpenAPI returned a non-2xx response"""
+
+    def __init__(self, code: Any, message: str):
+        super().__init__(f"{code} - {message}")
+        self.code = code
+        self.message = message
+
+
+def _create_http_client() -> httpx.AsyncClient:
+    """Create a pooled HTTP client for the DingTalk OpenAPI"""
+    return httpx.AsyncClient(
+        base_url=DINGTALK_API_BASE_URL,
+        timeout=10.0,
+        http2=True,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=75)
+    )
 
 
 class ContentType(Enum):
@@ -22,12 +44,16 @@ class ContentType(Enum):
     AI_CARD = "ai_card"
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class CardData:
-    """Data for AI Card content"""
+    """
+    Data for AI Card content
+    创建后不可修改（card_data 字典也不应再改动），编码结果在首次调用 to_json 时缓存
+    """
     card_data: Dict[str, Any] = None
     template_id: str = None
     options: Dict[str, Any] = None
+    _json: Optional[str] = field(default=None, init=False, repr=False, compare=False)
 
     def to_dict(self) -> Dict[str, Any]:
         """Convert to dictionary format"""
@@ -37,21 +63,65 @@ class CardData:
             "options": self.options
         }
 
+    def to_json(self) -> str:
+        """Encode to the JSON string expected in the card API content field"""
+        if self._json is None:
+            object.__setattr__(self, "_json", orjson.dumps(self.to_dict()).decode())
+        return self._json
+
 
 class DingTalkReplyService:
     """Service for sending replies to DingTalk conversations"""
 
     def __init__(self):
-        self.client = self._create_client()
+        # 每个事件循环一个连接池，卡片接口的 TCP/TLS 连接在消息之间复用
+        self._clients = LoopLocal(_create_http_client)
         self.auth = get_auth()
-
-    def _create_client(self) -> DingTalkAIClient:
-        """Create DingTalk AI client"""
-        config = open_api_models.Config(
-            protocol='https',
-            region_id='central'
+        # 最近一次成功调用卡片接口的时间（time.monotonic），供连接健康监控判断出站活跃度
+        self.last_outbound_time = 0.0
+        # 流式帧合并：每个会话只保留最新一帧，由该会话唯一的发送任务按最小间隔发出
+        self.min_update_interval = 0.08
+        self._pending_updates: Dict[str, CardData] = {}
+        self._flush_tasks: Dict[str, asyncio.Task] = {}
+
+    async def _post(self, path: str, access_token: str, body: Dict[str, Any]) -> Dict[str, Any]:
+        """POST to a DingTalk AI interaction API, raising DingTalkAPIError on failure"""
+        # 请求体直接用 orjson 编码成 bytes 发送，不经过 httpx 内部的标准库 json 编码
+        response = await self._clients.get().post(
+            path,
+            content=orjson.dumps(body),
+            headers={
+                "Content-Type": "application/json",
+                "x-acs-dingtalk-access-token": access_token
+            }
         )
-        return DingTalkAIClient(config)
+        if response.is_error:
+            try:
+                error = orjson.loads(response.content)
+            except orjson.JSONDecodeError:
+                error = {}
+            raise DingTalkAPIError(
+                error.get("code", response.status_code),
+                error.get("message", response.text)
+            )
+        self.last_outbound_time = time.monotonic()
+        return orjson.loads(response.content) if response.content else {}
+
+    async def close(self) -> None:
+        """Close the pooled HTTP clients of every event loop"""
+        current_loop = asyncio.get_running_loop()
+        for loop, client in self._clients.items():
+            if loop.is_closed():
+                continue
+            try:
+                if loop is current_loop:
+                    await client.aclose()
+                else:
+                    # 连接池属于其他线程的事件循环，交给该事件循环自己关闭
+                    future = asyncio.run_coroutine_threadsafe(client.aclose(), loop)
+                    await asyncio.wait_for(asyncio.wrap_future(future), timeout=5)
+            except Exception as e:
+                logger.warning(f"Failed to close DingTalk HTTP client: {str(e)}")
 
     async def reply(
         self,
@@ -74,40 +144,30 @@ class DingTalkReplyService:
         """
         try:
             # Get access token
-            access_token = self.auth.get_app_access_token()
+            access_token = await self.auth.get_app_access_token_async()
             if not access_token:
                 logger.error("Failed to get access token")
                 return False
 
-            # Prepare headers
-            headers = dingtalk_models.ReplyHeaders()
-            headers.x_acs_dingtalk_access_token = access_token
-
             # Prepare content
             if content_type == ContentType.AI_CARD and card_data:
-                content = json.dumps(card_data.to_dict())
+                content = card_data.to_json()
 
-            # Create request
-            request = dingtalk_models.ReplyRequest(
-                conversation_token=conversation_token,
-                content_type=content_type.value,
-                content=content
-            )
+            body = {
+                "conversationToken": conversation_token,
+                "contentType": content_type.value
+            }
+            if content is not None:
+                body["content"] = content
 
             # Send reply
-            await self.client.reply_with_options_async(
-                request,
-                headers,
-                util_models.RuntimeOptions()
-            )
+            await self._post("/v1.0/aiInteraction/reply", access_token, body)
 
             logger.info(f"Successfully sent {content_type.value} reply to conversation {conversation_token}")
             return True
 
         except Exception as e:
-            logger.error(f"Failed to send reply: {str(e)}")
-            if hasattr(e, 'code') and hasattr(e, 'message'):
-                logger.error(f"Error code: {e.code}, message: {e.message}")
+            log_api_error("Failed to send reply", e)
             return False
 
     async def reply_text(self, conversation_token: str, text: str) -> bool:
@@ -138,30 +198,25 @@ class DingTalkReplyService:
         主动模式下发送 loading 卡片，返回 conversation_token
         """
         try:
-            access_token = self.auth.get_app_access_token()
+            access_token = await self.auth.get_app_access_token_async()
             if not access_token:
                 logger.error("Failed to get access token")
                 return ""
 
-            headers = dingtalk_models.PrepareHeaders()
-            headers.x_acs_dingtalk_access_token = access_token
+            body = {
+                "contentType": content_type,
+                "content": card_data.to_json()
+            }
+            if open_conversation_id is not None:
+                body["openConversationId"] = open_conversation_id
+            if union_id is not None:
+                body["unionId"] = union_id
 
-            request = dingtalk_models.PrepareRequest(
-                open_conversation_id=open_conversation_id,
-                content_type=content_type,
-                content=json.dumps(card_data.to_dict()),
-                union_id=union_id
-            )
-
-            response = await self.client.prepare_with_options_async(
-                request,
-                headers,
-                util_models.RuntimeOptions()
-            )
+            response = await self._post("/v1.0/aiInteraction/prepare", access_token, body)
             # 返回 conversation_token
-            return response.body.result.conversation_token
+            return response["result"]["conversationToken"]
         except Exception as e:
-            logger.error(f"Failed to prepare card: {str(e)}")
+            log_api_error("Failed to prepare card", e)
             return ""
 
     async def update_card(
@@ -172,31 +227,68 @@ class DingTalkReplyService:
     ) -> bool:
         """
         主动模式下更新卡片内容
+        会先等待该会话尚未发出的流式帧发送完成，保证更新顺序
+        """
+        await self._drain_updates(conversation_token)
+        return await self._send_update(conversation_token, card_data, content_type)
+
+    def update_card_coalesced(self, conversation_token: str, card_data: CardData) -> None:
+        """
+        提交一帧流式更新，不等待发送
+        每帧都携带完整的流式内容，发送前被新帧覆盖的旧帧直接丢弃，
+        模型输出很快时出站请求数由 min_update_interval 限制
         """
+        self._pending_updates[conversation_token] = card_data
+        task = self._flush_tasks.get(conversation_token)
+        if task is None or task.done():
+            self._flush_tasks[conversation_token] = asyncio.create_task(
+                self._flush_updates(conversation_token)
+            )
+
+    async def _flush_updates(self, conversation_token: str) -> None:
+        """发送会话最新的流式帧，直到没有新帧提交"""
+        try:
+            while conversation_token in self._pending_updates:
+                card_data = self._pending_updates.pop(conversation_token)
+                await self._send_update(conversation_token, card_data)
+                if conversation_token in self._pending_updates:
+                    await asyncio.sleep(self.min_update_interval)
+        finally:
+            if self._flush_tasks.get(conversation_token) is asyncio.current_task():
+                del self._flush_tasks[conversation_token]
+
+    async def _drain_updates(self, conversation_token: str) -> None:
+        """等待会话的流式帧全部发出"""
+        task = self._flush_tasks.get(conversation_token)
+        if task is not None and task is not asyncio.current_task():
+            await asyncio.wait([task])
+
+    async def _send_update(
+        self,
+        conversation_token: str,
+        card_data: CardData,
+        content_type: str = "ai_card"
+    ) -> bool:
+        """调用卡片更新接口"""
         try:
-            access_token = self.auth.get_app_access_token()
+            access_token = await self.auth.get_app_access_token_async()
             if not access_token:
                 logger.error("Failed to get access token")
                 return False
 
-            headers = dingtalk_models.UpdateHeaders()
-            headers.x_acs_dingtalk_access_token = access_token
-
-            request = dingtalk_models.UpdateRequest(
-                conversation_token=conversation_token,
-                content_type=content_type,
-                content=json.dumps(card_data.to_dict())
-            )
-
-            await self.client.update_with_options_async(
-                request,
-                headers,
-                util_models.RuntimeOptions()
+            await self._post(
+                "/v1.0/aiInteraction/update",
+                access_token,
+                {
+                    "conversationToken": conversation_token,
+                    "contentType": content_type,
+                    "content": card_data.to_json()
+                }
             )
 
             return True
         except Exception as e:
-            logger.error(f"Failed to update card: {str(e)}")
+            log_api_error("Failed to update card", e)
             return False
 
     async def finish_card(
@@ -206,27 +298,21 @@ class DingTalkReplyService:
         """
         主动模式下完结卡片
         """
+        await self._drain_updates(conversation_token)
         try:
-            access_token = self.auth.get_app_access_token()
+            access_token = await self.auth.get_app_access_token_async()
             if not access_token:
                 logger.error("Failed to get access token")
                 return False
 
-            headers = dingtalk_models.FinishHeaders()
-            headers.x_acs_dingtalk_access_token = access_token
-
-            request = dingtalk_models.FinishRequest(
-                conversation_token=conversation_token
-            )
-
-            await self.client.finish_with_options_async(
-                request,
-                headers,
-                util_models.RuntimeOptions()
+            await self._post(
+                "/v1.0/aiInteraction/finish",
+                access_token,
+                {"conversationToken": conversation_token}
             )
             return True
         except Exception as e:
-            logger.error(f"Failed to finish card: {str(e)}")
+            log_api_error("Failed to finish card", e)
             return False
 
 
@@ -0,0 +1,14 @@
+from loguru import logger
+
+
+def log_api_error(prefix: str, e: Exception):
+    """
+    记录钉钉 OpenAPI 调用异常
+    SDK 抛出的 TeaException 带有 code 和 message，其余异常直接记录异常信息
+    """
+    code = getattr(e, "code", None)
+    message = getattr(e, "message", None)
+    if code is not None and message is not None:
+        logger.error(f"{prefix}: {code} - {message}")
+    else:
+        logger.error(f"{prefix}: {str(e)}")
@@ -0,0 +1,37 @@
+import asyncio
+import threading
+import weakref
+from typing import Callable, Generic, List, Tuple, TypeVar
+
+T = TypeVar("T")
+
+
+class LoopLocal(Generic[T]):
+    """
+    按事件循环缓存对象
+    dingtalk_stream 每次重连都会通过 asyncio.run 新建事件循环，
+    绑定在事件循环上的资源（httpx 连接池、MCP 子进程管道、asyncio.Lock）不能跨循环复用，
+    因此每个事件循环各自持有一份，事件循环被回收后对应的对象也随之释放
+    """
+
+    def __init__(self, factory: Callable[[], T]):
+        self._factory = factory
+        self._values: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, T]" = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def get(self) -> T:
+        """获取当前事件循环对应的对象，首次访问时创建，必须在事件循环中调用"""
+        loop = asyncio.get_running_loop()
+        value = self._values.get(loop)
+        if value is None:
+            with self._lock:
+                value = self._values.get(loop)
+                if value is None:
+                    value = self._factory()
+                    self._values[loop] = value
+        return value
+
+    def items(self) -> List[Tuple[asyncio.AbstractEventLoop, T]]:
+        """返回当前仍存活的 (事件循环, 对象) 列表"""
+        with self._lock:
+            return list(self._values.items())
@@ -1,34 +1,37 @@
 import time
 
 class Stopwatch:
+    """计时器，内部以整数纳秒累计，elapsed 返回毫秒"""
+
     def __init__(self):
         self.start_time = None
-        self.elapsed_time = 0
+        self.elapsed_ns = 0
 
     def start(self):
         if self.start_time is not None:
             raise RuntimeError("Stopwatch is already running")
-        self.start_time = time.perf_counter() * 1000
+        self.start_time = time.perf_counter_ns()
 
     def stop(self):
         if self.start_time is None:
             raise RuntimeError("Stopwatch is not running")
-        end_time = time.perf_counter() * 1000
-        self.elapsed_time += end_time - self.start_time
+        self.elapsed_ns += time.perf_counter_ns() - self.start_time
         self.start_time = None
 
     def reset(self):
         self.start_time = None
-        self.elapsed_time = 0
+        self.elapsed_ns = 0
 
     def elapsed(self) -> float:
+        elapsed_ns = self.elapsed_ns
         if self.start_time is not None:
-            return self.elapsed_time + (time.perf_counter() * 1000 - self.start_time)
-        return self.elapsed_time
+            elapsed_ns += time.perf_counter_ns() - self.start_time
+        return elapsed_ns / 1e6
 
 # 示例用法
-stopwatch = Stopwatch()
-stopwatch.start()
-time.sleep(1)  # 模拟耗时操作
-stopwatch.stop()
-print(f"Elapsed time: {stopwatch.elapsed()} seconds")
\ No newline at end of file
+if __name__ == "__main__":
+    stopwatch = Stopwatch()
+    stopwatch.start()
+    time.sleep(1)  # 模拟耗时操作
+    stopwatch.stop()
+    print(f"Elapsed time: {stopwatch.elapsed()} ms")
@@ -9,32 +9,40 @@ import signal
 from loguru import logger
 
 from app.dingtalk.stream_client import DingTalkStreamManager
+from app.service.reply_service import reply_service
 
 stream_manager = DingTalkStreamManager()
 
-shutdown_event = asyncio.Event()
-
 def configure_logging():
     """Configure logging with enhanced settings"""
     # Remove default handler
     logger.remove()
     
     # Add colored console handler with better formatting
+    # enqueue=True: 日志经队列由后台线程写出，流式输出时不会阻塞事件循环
+    # backtrace/diagnose 关闭后异常日志不再逐帧展开变量值，记录异常时开销更小
     logger.add(
         sys.stderr,
         format="<green>{time:YYYY-MM-DD HH:mm:ss.SSS}</green> | <level>{level: <8}</level> | <cyan>{name}</cyan>:<cyan>{line}</cyan> - <level>{message}</level>",
-        level="INFO"
+        level="INFO",
+        enqueue=True,
+        backtrace=False,
+        diagnose=False
     )
     
     # Add file handler for persistent logs
+    # loguru 打开日志文件时会自动创建目录；delay=True 推迟到第一条日志写入时才打开文件
     log_dir = "logs"
-    os.makedirs(log_dir, exist_ok=True)
     logger.add(
         os.path.join(log_dir, "app_{time:YYYY-MM-DD}.log"),
         rotation="12:00",  # New file at noon
         retention="7 days",  # Keep logs for 7 days
         compression="zip",  # Compress old log files
-        level="DEBUG"
+        level="DEBUG",
+        delay=True,
+        enqueue=True,
+        backtrace=False,
+        diagnose=False
     )
 
 
@@ -47,13 +55,12 @@ def start_stream_client():
         logger.error(f"钉钉流客户端启动失败: {str(e)}")
         raise
 
-def handle_signal():
-    shutdown_event.set()
-
 async def stop_stream_client():
     """停止钉钉流客户端"""
     try:
         stream_manager.stop()
+        # 关闭卡片接口的 HTTP 连接池
+        await reply_service.close()
         logger.info("钉钉流客户端停止成功")
     except Exception as e:
         logger.error(f"钉钉流客户端停止失败: {str(e)}")
@@ -67,11 +74,22 @@ async def main():
     start_stream_client()
 
     # Set up signal handlers
+    # 事件在运行中的事件循环里创建，信号到来时直接 set
+    shutdown_event = asyncio.Event()
     loop = asyncio.get_running_loop()
     for sig in (signal.SIGINT, signal.SIGTERM):
-        loop.add_signal_handler(sig, handle_signal)
+        loop.add_signal_handler(sig, shutdown_event.set)
     await shutdown_event.wait()
     await stop_stream_client()
 
 if __name__ == "__main__":
+    try:
+        # uvloop 基于 libuv，MCP 子进程管道、LLM 流式响应和卡片更新都跑在事件循环上；
+        # 只在入口设置事件循环策略，导入项目模块不会改变全局策略。
+        # 设置策略而不是调用 uvloop.run，流客户端重连时在线程中新建的事件循环也会使用 uvloop
+        # （Windows 不支持，回退到默认循环）
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
     asyncio.run(main())
\ No newline at end of file